@@ -0,0 +1,78 @@
+# Benchmark of `utils.config_utils.extract_jsons` against the regex implementation it replaced.
+#
+# The texts imitate LLM annotations: some reasoning, then a flat, nested or pretty-printed JSON object, and
+# sometimes braces in the prose. Both implementations run over the same texts; the report has their throughput
+# and how many objects each recovered.
+#
+#   python -m benchmarks.json_extraction --num_texts 100000 --num_workers 8
+
+import re
+import json
+import time
+import random
+from typing import Dict, List, Optional
+from fire import Fire
+from utils.config_utils import extract_jsons, extract_jsons_batch
+
+
+def legacy_extract_jsons(text):
+    text = re.sub(r"\s+", " ", text)
+    matches = re.findall(r"\{.*?\}", text)
+    parsed_jsons = []
+    for match in matches:
+        try:
+            json_object = json.loads(match)
+            parsed_jsons.append(json_object)
+        except ValueError:
+            pass
+    return parsed_jsons
+
+
+def make_texts(num_texts: int, seed: int = 42, reasoning_length: int = 4) -> List[str]:
+    rng = random.Random(seed)
+    reasoning = "来访者表达了对工作的焦虑和对未来的不确定感，倾听者需要先共情再询问具体情况。" * reasoning_length
+    texts = []
+    for idx in range(num_texts):
+        state = {"observation": "最近失眠", "feeling": "焦虑", "need": "被理解", "request": "想聊聊"}
+        kind = idx % 4
+        if kind == 0:
+            annotation = json.dumps(state, ensure_ascii=False)
+        elif kind == 1:
+            annotation = json.dumps({"user_state": state, "strategy": ["共情", "询问"]}, ensure_ascii=False)
+        elif kind == 2:
+            annotation = json.dumps({"user_state": state, "score": rng.randint(1, 10)}, ensure_ascii=False, indent=4)
+        else:
+            annotation = "{注：以下为结果} " + json.dumps(state, ensure_ascii=False)
+        texts.append(f"{reasoning}\n结果如下：\n{annotation}\n以上。")
+    return texts
+
+
+def run(name: str, extract, texts: List[str]) -> Dict:
+    start = time.perf_counter()
+    results = extract(texts)
+    elapsed = time.perf_counter() - start
+    objects = sum(len(result) for result in results)
+    nested = sum(
+        any(isinstance(value, (dict, list)) for obj in result for value in obj.values()) for result in results
+    )
+    print(f"{name:<28}{elapsed:>10.2f}s{len(texts) / elapsed:>14.0f} texts/s{objects:>10} objects"
+          f"{nested:>10} nested")
+    return {"elapsed_s": elapsed, "texts_per_s": len(texts) / elapsed, "objects": objects, "nested": nested}
+
+
+def main(
+        num_texts: int = 100000, num_workers: Optional[int] = None, seed: int = 42, reasoning_length: int = 4
+) -> None:
+    r"""
+    The process pool only pays off on several cores, when extraction outweighs sending the texts to the workers,
+    i.e. for long texts (raise `reasoning_length`) or many JSON objects per text.
+    """
+    texts = make_texts(num_texts, seed, reasoning_length)
+    run("legacy regex", lambda batch: [legacy_extract_jsons(text) for text in batch], texts)
+    run("brace scanner", lambda batch: [extract_jsons(text) for text in batch], texts)
+    if num_workers:
+        run(f"brace scanner x{num_workers} procs", lambda batch: extract_jsons_batch(batch, num_workers), texts)
+
+
+if __name__ == "__main__":
+    Fire(main)
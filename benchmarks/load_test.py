@@ -0,0 +1,228 @@
+# Load test for the study web app in `user_interface/main_app.py`.
+#
+# Every virtual user walks the participant flow: login -> pre-questions -> dashboard -> (chat -> selected_response
+# -> feedback -> rating) x turns -> survey -> overall_feedback, and the latency of every request is recorded per
+# endpoint. By default the app runs in-process with the CPU-only fake model backend; pass `url` to drive a running
+# server instead (e.g. one started with the real vLLM backend).
+#
+#   python -m benchmarks.load_test --users 32 --turns 5
+#   python -m benchmarks.load_test --users 8 --url http://localhost:8000 --stream
+
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import tempfile
+from collections import defaultdict
+from typing import Dict, List, Optional
+import httpx
+from fire import Fire
+
+USER_MESSAGES = [
+    "最近工作压力很大，晚上总是睡不着。",
+    "我和家人吵架了，不知道该怎么和他们沟通。",
+    "I feel lonely since I moved to a new city.",
+    "考试又没考好，感觉自己什么都做不好。",
+    "My friend stopped talking to me and I don't know why.",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of `values` (0 < q <= 100)."""
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+class LoadTest:
+    def __init__(self, turns: int, stream: bool, think_time: float, seed: int) -> None:
+        self.turns = turns
+        self.stream = stream
+        self.think_time = think_time
+        self.random = random.Random(seed)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def request(self, client: httpx.AsyncClient, name: str, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.latencies[name].append(time.perf_counter() - start)
+        return response
+
+    async def chat_stream(self, client: httpx.AsyncClient, message: str) -> Dict:
+        start = time.perf_counter()
+        first_token, done = None, None
+        try:
+            async with client.stream("POST", "/chat_stream", data={"message": message}) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event["event"] == "token" and first_token is None:
+                        first_token = time.perf_counter() - start
+                    elif event["event"] == "done":
+                        done = event
+        except httpx.HTTPError:
+            self.errors["/chat_stream"] += 1
+            raise
+        finally:
+            self.latencies["/chat_stream"].append(time.perf_counter() - start)
+        if first_token is not None:
+            self.latencies["/chat_stream (first token)"].append(first_token)
+        return done
+
+    async def think(self) -> None:
+        if self.think_time > 0:
+            await asyncio.sleep(self.random.uniform(0, 2 * self.think_time))
+
+    async def session(self, client: httpx.AsyncClient, user_id: int) -> None:
+        await self.request(client, "/login", "POST", "/login",
+                           data={"username": f"bench_{user_id}", "password": "test_mode"})
+        await self.request(client, "/submit-pre-questions", "POST", "/submit-pre-questions",
+                           json={"description": "benchmark participant", "keywords": ["压力"]})
+        await self.request(client, "/dashboard", "GET", "/dashboard")
+
+        for _ in range(self.turns):
+            await self.think()
+            message = self.random.choice(USER_MESSAGES)
+            if self.stream:
+                reply = await self.chat_stream(client, message)
+            else:
+                reply = (await self.request(client, "/chat", "POST", "/chat", data={"message": message})).json()
+
+            response_id = reply["response_id"]
+            await self.think()
+            await self.request(client, "/selected_response", "POST", "/selected_response",
+                               data={"message": reply["reply_options"][0], "response_id": response_id})
+            await self.request(client, "/feedback", "POST", "/feedback",
+                               data={"response_id": response_id, "feedback": "thumb_up"})
+            await self.request(client, "/rating", "POST", "/rating",
+                               data={"response_id": response_id, "rating": self.random.randint(1, 10)})
+
+        await self.request(client, "/survey", "GET", "/survey")
+        await self.request(client, "/overall_feedback", "POST", "/overall_feedback", json={
+            "calm_excited": 3, "unpleasant_pleasant": 4, "supportiveness": 5, "engagement": 4
+        })
+
+    def report(self, elapsed: float, sessions: int, failed: int) -> Dict:
+        endpoints = {}
+        for name, values in self.latencies.items():
+            endpoints[name] = {
+                "count": len(values),
+                "errors": self.errors.get(name, 0),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": max(values) * 1000,
+            }
+        total = sum(len(values) for name, values in self.latencies.items() if "first token" not in name)
+        return {
+            "elapsed_s": elapsed,
+            "sessions": sessions,
+            "failed_sessions": failed,
+            "requests": total,
+            "requests_per_s": total / elapsed,
+            "sessions_per_s": (sessions - failed) / elapsed,
+            "endpoints": endpoints,
+        }
+
+
+def print_report(report: Dict) -> None:
+    print(f"{'endpoint':<28}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in report["endpoints"].items():
+        print(f"{name:<28}{stats['count']:>8}{stats['errors']:>8}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    print(f"\n{report['sessions'] - report['failed_sessions']}/{report['sessions']} sessions in "
+          f"{report['elapsed_s']:.1f}s, {report['requests_per_s']:.1f} requests/s, "
+          f"{report['sessions_per_s']:.2f} sessions/s")
+
+
+async def run(
+        users: int, turns: int, url: Optional[str], backend: str, stream: bool, think_time: float, ramp_up: float,
+        seed: int, keep_dialogues: bool = False
+) -> Dict:
+    dialogue_dir = None
+    if url is None:
+        # import the app only now, so the backend and the dialogue directory can be chosen first
+        os.environ.setdefault("MODEL_BACKEND", backend)
+        if "DIALOGUE_DIR" not in os.environ:
+            if keep_dialogues:
+                os.environ["DIALOGUE_DIR"] = tempfile.mkdtemp(prefix="dialogues_")
+                print(f"Session logs are kept in {os.environ['DIALOGUE_DIR']}")
+            else:
+                dialogue_dir = tempfile.TemporaryDirectory(prefix="dialogues_")
+                os.environ["DIALOGUE_DIR"] = dialogue_dir.name
+        from user_interface.main_app import app, session_store
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://testserver"
+        flusher = asyncio.create_task(session_store.run())  # ASGITransport does not run startup events
+    else:
+        transport, base_url, flusher = None, url, None
+
+    test = LoadTest(turns, stream, think_time, seed)
+
+    async def virtual_user(user_id: int) -> bool:
+        await asyncio.sleep(ramp_up * user_id / max(users, 1))
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=600) as client:
+            try:
+                await test.session(client, user_id)
+                return True
+            except (httpx.HTTPError, KeyError, ValueError):
+                return False
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*[virtual_user(user_id) for user_id in range(users)])
+        elapsed = time.perf_counter() - start
+    finally:
+        if flusher is not None:
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)  # let a running flush finish before cleanup
+        if dialogue_dir is not None:
+            dialogue_dir.cleanup()
+    return test.report(elapsed, users, results.count(False))
+
+
+def main(
+        users: int = 16,
+        turns: int = 5,
+        url: Optional[str] = None,
+        backend: str = "fake",
+        stream: bool = False,
+        think_time: float = 0.0,
+        ramp_up: float = 0.0,
+        seed: int = 42,
+        output: Optional[str] = None,
+        keep_dialogues: bool = False
+) -> None:
+    r"""
+    Runs `users` concurrent virtual participants with `turns` chat turns each and reports per-endpoint latency.
+
+    Args:
+        url: address of a running app; if omitted the app runs in-process with the `backend` model backend
+            ("fake" or "vllm").
+        stream: use `/chat_stream` instead of `/chat` and also report the time to the first token (only meaningful
+            with `url`, since the in-process transport buffers the whole response).
+        think_time: mean pause (seconds) of a participant between actions.
+        ramp_up: seconds over which the virtual users are started.
+        output: optional path to save the report as JSON.
+        keep_dialogues: keep the session logs of an in-process run instead of deleting them afterwards.
+    """
+    report = asyncio.run(run(users, turns, url, backend, stream, think_time, ramp_up, seed, keep_dialogues))
+    print_report(report)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    Fire(main)
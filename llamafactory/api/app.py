@@ -92,7 +92,9 @@ def create_app(chat_model: "ChatModel") -> "FastAPI":
     )
     async def list_models():
         model_card = ModelCard(id=os.getenv("API_MODEL_NAME", "gpt-3.5-turbo"))
-        return ModelList(data=[model_card])
+        # adapters served by the vllm engine, selected with the `model` field of a request
+        adapter_cards = [ModelCard(id=name) for name in getattr(chat_model.engine, "lora_requests", {})]
+        return ModelList(data=[model_card] + adapter_cards)
 
     @app.post(
         "/v1/chat/completions",
@@ -0,0 +1,334 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import queue
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Callable, Dict, List, Optional
+
+import torch
+from transformers import (
+    DynamicCache,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from ..extras import logging
+
+
+if TYPE_CHECKING:
+    from transformers import GenerationConfig, PreTrainedModel, PreTrainedTokenizer
+
+
+logger = logging.get_logger(__name__)
+
+
+class TokenChannel:
+    r"""
+    Hands text from a worker thread to a coroutine. The event loop is woken once for all the tokens that arrived
+    since the consumer last ran, instead of once per token. `None` ends the stream and an exception is re-raised.
+    """
+
+    def __init__(self, loop: "asyncio.AbstractEventLoop") -> None:
+        self.closed = False  # set when the consumer stops reading
+        self._loop = loop
+        self._items = deque()
+        self._lock = Lock()
+        self._scheduled = False
+        self._ready = asyncio.Event()
+
+    def put(self, item: Any) -> None:
+        with self._lock:
+            self._items.append(item)
+            if self._scheduled:
+                return
+
+            self._scheduled = True
+
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        with self._lock:
+            self._scheduled = False
+
+        self._ready.set()
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        try:
+            while True:
+                with self._lock:
+                    items = list(self._items)
+                    self._items.clear()
+                    if not items:
+                        self._ready.clear()
+
+                if not items:
+                    await self._ready.wait()
+                    continue
+
+                texts = [item for item in items if isinstance(item, str)]
+                if texts:
+                    yield "".join(texts)
+
+                for item in items:
+                    if isinstance(item, BaseException):
+                        raise item
+
+                if items[-1] is None:
+                    return
+        finally:
+            self.closed = True
+
+
+@dataclass
+class _Sequence:
+    input_ids: "torch.Tensor"  # prompt and generated ids on the model device, for the logits processors
+    processors: "LogitsProcessorList"
+    do_sample: bool
+    eos_token_ids: List[int]
+    max_new_tokens: int
+    emit: Callable[[Any], None]
+    output_ids: List[int] = field(default_factory=list)
+    prefix_offset: int = 0
+    read_offset: int = 0
+    cancelled: bool = False
+
+
+def _left_pad(tensor: "torch.Tensor", length: int, dim: int) -> "torch.Tensor":
+    if tensor.size(dim) == length:
+        return tensor
+
+    shape = list(tensor.shape)
+    shape[dim] = length - tensor.size(dim)
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def _get_processors(generation_config: "GenerationConfig", logits_processor: "LogitsProcessorList"):
+    processors = LogitsProcessorList(logits_processor)
+    if generation_config.repetition_penalty is not None and generation_config.repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(generation_config.repetition_penalty))
+
+    if generation_config.do_sample:
+        if generation_config.temperature is not None and generation_config.temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(generation_config.temperature))
+
+        if generation_config.top_k:
+            processors.append(TopKLogitsWarper(generation_config.top_k))
+
+        if generation_config.top_p is not None and generation_config.top_p < 1.0:
+            processors.append(TopPLogitsWarper(generation_config.top_p))
+
+    return processors
+
+
+class ContinuousBatcher:
+    r"""
+    Iteration-level batching for streamed generation with the huggingface backend.
+
+    One worker thread owns the model. Between decode steps it prefills newly arrived sequences and merges their
+    KV caches into the running batch (left-padded to a common length), and it evicts finished or cancelled
+    sequences, so a long generation never holds back the requests that arrive after it. Tokens are pushed to
+    the `TokenChannel` of each request.
+    """
+
+    def __init__(self, model: "PreTrainedModel", tokenizer: "PreTrainedTokenizer", max_running: int = 16) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_running = max_running
+        self._pending: "queue.Queue[_Sequence]" = queue.Queue()
+        self._running: List["_Sequence"] = []
+        self._cache: Optional["DynamicCache"] = None
+        self._attention_mask: Optional["torch.Tensor"] = None
+        self._thread: Optional["Thread"] = None
+
+    async def stream(self, gen_kwargs: Dict[str, Any], prompt_length: int) -> AsyncGenerator[str, None]:
+        r"""
+        Streams the text generated for the prompt and generation config prepared by `_process_args`.
+        """
+        channel = TokenChannel(asyncio.get_running_loop())
+        generation_config: "GenerationConfig" = gen_kwargs["generation_config"]
+        eos_token_ids = generation_config.eos_token_id
+        if generation_config.max_new_tokens is not None:
+            max_new_tokens = generation_config.max_new_tokens
+        else:
+            max_new_tokens = generation_config.max_length - prompt_length
+
+        sequence = _Sequence(
+            input_ids=gen_kwargs["inputs"],
+            processors=_get_processors(generation_config, gen_kwargs["logits_processor"]),
+            do_sample=bool(generation_config.do_sample),
+            eos_token_ids=eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids],
+            max_new_tokens=max_new_tokens,
+            emit=channel.put,
+        )
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+        self._pending.put(sequence)
+        try:
+            async for text in channel.stream():
+                yield text
+        finally:
+            sequence.cancelled = True  # evicted at the next step if it is still running
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self._step()
+            except Exception as e:
+                logger.warning_rank0(f"Continuous batching failed: {e}")
+                for sequence in self._running:
+                    sequence.emit(e)
+
+                self._running, self._cache, self._attention_mask = [], None, None
+
+    @torch.inference_mode()
+    def _step(self) -> None:
+        self._evict()
+        if not self._running:
+            self._admit(self._pending.get())  # block until a request arrives
+
+        while len(self._running) < self.max_running and not self._pending.empty():
+            self._admit(self._pending.get_nowait())
+
+        self._evict()  # sequences finished by their first token
+        if self._running:
+            device = self._attention_mask.device
+            input_ids = torch.tensor([[sequence.output_ids[-1]] for sequence in self._running], device=device)
+            self._attention_mask = torch.cat(
+                [self._attention_mask, self._attention_mask.new_ones((len(self._running), 1))], dim=-1
+            )
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=self._attention_mask,
+                position_ids=self._attention_mask.long().cumsum(-1)[:, -1:] - 1,
+                past_key_values=self._cache,
+                use_cache=True,
+            )
+            self._cache = outputs.past_key_values
+            self._sample(self._running, outputs.logits[:, -1, :].float())
+
+    def _admit(self, sequence: "_Sequence") -> None:
+        r"""
+        Prefills a new sequence alone and merges its KV cache into the running batch.
+        """
+        if sequence.cancelled:
+            return
+
+        self._running.append(sequence)
+        attention_mask = torch.ones_like(sequence.input_ids)
+        outputs = self.model(
+            input_ids=sequence.input_ids, attention_mask=attention_mask, past_key_values=DynamicCache(), use_cache=True
+        )
+        self._sample([sequence], outputs.logits[:, -1, :].float())
+        if self._cache is None:
+            self._cache, self._attention_mask = outputs.past_key_values, attention_mask
+        else:
+            cache = outputs.past_key_values
+            length = max(self._attention_mask.size(-1), attention_mask.size(-1))
+            for layer_idx in range(len(self._cache.key_cache)):
+                self._cache.key_cache[layer_idx] = torch.cat(
+                    [
+                        _left_pad(self._cache.key_cache[layer_idx], length, dim=-2),
+                        _left_pad(cache.key_cache[layer_idx], length, dim=-2),
+                    ]
+                )
+                self._cache.value_cache[layer_idx] = torch.cat(
+                    [
+                        _left_pad(self._cache.value_cache[layer_idx], length, dim=-2),
+                        _left_pad(cache.value_cache[layer_idx], length, dim=-2),
+                    ]
+                )
+
+            self._cache._seen_tokens = length
+            self._attention_mask = torch.cat(
+                [_left_pad(self._attention_mask, length, dim=-1), _left_pad(attention_mask, length, dim=-1)]
+            )
+
+    def _sample(self, sequences: List["_Sequence"], logits: "torch.Tensor") -> None:
+        r"""
+        Samples the next token of each sequence on the device, then reads them all with a single sync.
+        """
+        tokens = []
+        for idx, sequence in enumerate(sequences):
+            scores = sequence.processors(sequence.input_ids, logits[idx : idx + 1])
+            if sequence.do_sample:
+                token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1)
+            else:
+                token = scores.argmax(dim=-1, keepdim=True)
+
+            sequence.input_ids = torch.cat([sequence.input_ids, token], dim=-1)
+            tokens.append(token)
+
+        for sequence, token_id in zip(sequences, torch.cat(tokens).view(-1).tolist()):
+            sequence.output_ids.append(token_id)
+            if token_id not in sequence.eos_token_ids:
+                text = self._decode(sequence)
+                if text:
+                    sequence.emit(text)
+
+    def _decode(self, sequence: "_Sequence", final: bool = False) -> str:
+        r"""
+        Decodes the new tokens of a sequence, holding back incomplete characters unless `final`.
+        """
+        output_ids = [token_id for token_id in sequence.output_ids if token_id not in sequence.eos_token_ids]
+        prefix_ids = output_ids[sequence.prefix_offset : sequence.read_offset]
+        prefix = self.tokenizer.decode(prefix_ids, skip_special_tokens=True)
+        text = self.tokenizer.decode(output_ids[sequence.prefix_offset :], skip_special_tokens=True)
+        if len(text) > len(prefix) and (final or not text.endswith("�")):
+            sequence.prefix_offset, sequence.read_offset = sequence.read_offset, len(output_ids)
+            return text[len(prefix) :]
+
+        return ""
+
+    def _evict(self) -> None:
+        keep = []
+        for idx, sequence in enumerate(self._running):
+            if sequence.cancelled:
+                continue
+
+            finished = sequence.output_ids[-1] in sequence.eos_token_ids
+            if finished or len(sequence.output_ids) >= sequence.max_new_tokens:
+                text = self._decode(sequence, final=True)
+                if text:
+                    sequence.emit(text)
+
+                sequence.emit(None)
+            else:
+                keep.append(idx)
+
+        if len(keep) == len(self._running):
+            return
+
+        self._running = [self._running[idx] for idx in keep]
+        if not self._running:
+            self._cache, self._attention_mask = None, None
+            return
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask.index_select(0, index)
+        start = attention_mask.any(dim=0).nonzero()[0].item()  # drop the columns that are now padding only
+        self._attention_mask = attention_mask[:, start:]
+        for layer_idx in range(len(self._cache.key_cache)):
+            key_cache, value_cache = self._cache.key_cache[layer_idx], self._cache.value_cache[layer_idx]
+            self._cache.key_cache[layer_idx] = key_cache.index_select(0, index)[:, :, start:]
+            self._cache.value_cache[layer_idx] = value_cache.index_select(0, index)[:, :, start:]
+
+        self._cache._seen_tokens = self._attention_mask.size(-1)
@@ -15,11 +15,10 @@
 import asyncio
 import concurrent.futures
 import os
-from threading import Thread
-from typing import TYPE_CHECKING, Any, AsyncGenerator, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
-from transformers import GenerationConfig, TextIteratorStreamer
+from transformers import GenerationConfig, StoppingCriteria, StoppingCriteriaList, TextStreamer
 from typing_extensions import override
 
 from ..data import get_template_and_fix_tokenizer
@@ -28,6 +27,7 @@ from ..extras.constants import IMAGE_PLACEHOLDER, VIDEO_PLACEHOLDER
 from ..extras.misc import get_logits_processor
 from ..model import load_model, load_tokenizer
 from .base_engine import BaseEngine, Response
+from .continuous_batching import ContinuousBatcher, TokenChannel
 
 
 if TYPE_CHECKING:
@@ -41,6 +41,38 @@ if TYPE_CHECKING:
 
 logger = logging.get_logger(__name__)
 
+# requests whose generate arguments are only these (no multimodal inputs) can share a batch
+_BATCHABLE_KEYS = {"inputs", "attention_mask", "generation_config", "logits_processor"}
+
+
+class _ChannelStreamer(TextStreamer):
+    r"""
+    Sends the decoded text of `generate` to a `TokenChannel`.
+    """
+
+    def __init__(self, channel: "TokenChannel", tokenizer: "PreTrainedTokenizer", **kwargs) -> None:
+        super().__init__(tokenizer, **kwargs)
+        self.channel = channel
+
+    def on_finalized_text(self, text: str, stream_end: bool = False) -> None:
+        if text:
+            self.channel.put(text)
+
+        if stream_end:
+            self.channel.put(None)
+
+
+class _ChannelClosed(StoppingCriteria):
+    r"""
+    Stops `generate` once nobody reads the stream anymore, e.g. after the client disconnected.
+    """
+
+    def __init__(self, channel: "TokenChannel") -> None:
+        self.channel = channel
+
+    def __call__(self, input_ids: "torch.Tensor", scores: "torch.Tensor", **kwargs) -> "torch.BoolTensor":
+        return torch.full((input_ids.shape[0],), self.channel.closed, dtype=torch.bool, device=input_ids.device)
+
 
 class HuggingfaceEngine(BaseEngine):
     def __init__(
@@ -67,7 +99,26 @@ class HuggingfaceEngine(BaseEngine):
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
 
-        self.semaphore = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT", "1")))
+        max_concurrent = int(os.getenv("MAX_CONCURRENT", "1"))
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        # one long-lived pool for the blocking calls, instead of a new pool (and threads) per request
+        # one worker beyond the generations, so requests are tokenized while the others generate
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrent + 1, thread_name_prefix="hf_engine"
+        )
+        # micro-batching of `chat` requests: wait up to `BATCH_WAIT_MS` for up to `MAX_BATCH_SIZE` requests
+        self.max_batch_size = int(os.getenv("MAX_BATCH_SIZE", "1"))
+        self.batch_wait = float(os.getenv("BATCH_WAIT_MS", "10")) / 1000
+        self._batch_queue: Optional["asyncio.Queue"] = None
+        self._batch_task: Optional["asyncio.Task"] = None
+        # padded tokens per forward pass of `get_scores`
+        self.max_score_tokens = int(os.getenv("MAX_SCORE_TOKENS", "16384"))
+        # continuous batching of `stream_chat` requests, up to `MAX_RUNNING_SEQS` sequences per decode step
+        self.continuous_batcher: Optional["ContinuousBatcher"] = None
+        if os.getenv("CONTINUOUS_BATCHING", "0").lower() in ["true", "1"]:
+            self.continuous_batcher = ContinuousBatcher(
+                self.model, self.tokenizer, max_running=int(os.getenv("MAX_RUNNING_SEQS", "16"))
+            )
 
     @staticmethod
     def _process_args(
@@ -203,6 +254,16 @@ class HuggingfaceEngine(BaseEngine):
             videos,
             input_kwargs,
         )
+        return HuggingfaceEngine._generate(model, tokenizer, gen_kwargs, prompt_length)
+
+    @staticmethod
+    @torch.inference_mode()
+    def _generate(
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        gen_kwargs: Dict[str, Any],
+        prompt_length: int,
+    ) -> List["Response"]:
         generate_output = model.generate(**gen_kwargs)
         response_ids = generate_output[:, prompt_length:]
         response = tokenizer.batch_decode(response_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
@@ -223,44 +284,127 @@ class HuggingfaceEngine(BaseEngine):
 
     @staticmethod
     @torch.inference_mode()
-    def _stream_chat(
+    def _batch_chat(
         model: "PreTrainedModel",
         tokenizer: "PreTrainedTokenizer",
-        processor: Optional["ProcessorMixin"],
-        template: "Template",
-        generating_args: Dict[str, Any],
-        messages: Sequence[Dict[str, str]],
-        system: Optional[str] = None,
-        tools: Optional[str] = None,
-        images: Optional[Sequence["ImageInput"]] = None,
-        videos: Optional[Sequence["VideoInput"]] = None,
-        input_kwargs: Optional[Dict[str, Any]] = {},
-    ) -> Callable[[], str]:
-        gen_kwargs, _ = HuggingfaceEngine._process_args(
-            model,
-            tokenizer,
-            processor,
-            template,
-            generating_args,
-            messages,
-            system,
-            tools,
-            images,
-            videos,
-            input_kwargs,
+        batch_kwargs: List[Dict[str, Any]],
+        prompt_lengths: List[int],
+    ) -> List[List["Response"]]:
+        r"""
+        Left-pads the prompts of several requests sharing one generation config into a single `generate` call,
+        and splits the outputs back into the responses of each request.
+        """
+        padded_length = max(prompt_lengths)
+        inputs = torch.full(
+            (len(batch_kwargs), padded_length), tokenizer.pad_token_id, dtype=torch.long, device=model.device
+        )
+        attention_mask = torch.zeros_like(inputs, dtype=torch.bool)
+        for i, (gen_kwargs, prompt_length) in enumerate(zip(batch_kwargs, prompt_lengths)):
+            inputs[i, padded_length - prompt_length :] = gen_kwargs["inputs"][0]
+            attention_mask[i, padded_length - prompt_length :] = True
+
+        generate_output = model.generate(
+            inputs=inputs,
+            attention_mask=attention_mask,
+            generation_config=batch_kwargs[0]["generation_config"],
+            logits_processor=batch_kwargs[0]["logits_processor"],
         )
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-        gen_kwargs["streamer"] = streamer
-        thread = Thread(target=model.generate, kwargs=gen_kwargs, daemon=True)
-        thread.start()
+        response_ids = generate_output[:, padded_length:]
+        response = tokenizer.batch_decode(response_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        num_return_sequences = batch_kwargs[0]["generation_config"].num_return_sequences or 1
+        results = []
+        for idx, prompt_length in enumerate(prompt_lengths):
+            request_results = []
+            for i in range(idx * num_return_sequences, (idx + 1) * num_return_sequences):
+                eos_index = (response_ids[i] == tokenizer.eos_token_id).nonzero()
+                response_length = (eos_index[0].item() + 1) if len(eos_index) else len(response_ids[i])
+                request_results.append(
+                    Response(
+                        response_text=response[i],
+                        response_length=response_length,
+                        prompt_length=prompt_length,
+                        finish_reason="stop" if len(eos_index) else "length",
+                    )
+                )
 
-        def stream():
-            try:
-                return streamer.__next__()
-            except StopIteration:
-                raise StopAsyncIteration()
+            results.append(request_results)
 
-        return stream
+        return results
+
+    async def _run_batches(self) -> None:
+        r"""
+        Collects queued `chat` requests for `batch_wait` seconds (or until `max_batch_size` arrive) and runs each
+        group with the same generation config as one batch.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                if not self._batch_queue.empty():
+                    batch.append(self._batch_queue.get_nowait())
+                    continue
+
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups: Dict[str, List[Tuple[Dict[str, Any], int, "asyncio.Future"]]] = {}
+            for gen_kwargs, prompt_length, future in batch:
+                if not future.done():  # skip requests cancelled while waiting
+                    key = gen_kwargs["generation_config"].to_json_string()
+                    groups.setdefault(key, []).append((gen_kwargs, prompt_length, future))
+
+            for group in groups.values():
+                batch_kwargs, prompt_lengths, futures = zip(*group)
+                input_args = (self.model, self.tokenizer, batch_kwargs, prompt_lengths)
+                try:
+                    async with self.semaphore:
+                        results = await loop.run_in_executor(self.pool, self._batch_chat, *input_args)
+                except Exception as e:
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for future, result in zip(futures, results):
+                        if not future.done():
+                            future.set_result(result)
+
+    async def _submit_batched(self, gen_kwargs: Dict[str, Any], prompt_length: int) -> List["Response"]:
+        r"""
+        Queues a request prepared by `_process_args` for the micro-batcher.
+        """
+        loop = asyncio.get_running_loop()
+        if self._batch_task is None or self._batch_task.done() or self._batch_task.get_loop() is not loop:
+            self._batch_queue = asyncio.Queue()
+            self._batch_task = loop.create_task(self._run_batches())
+
+        future = loop.create_future()
+        await self._batch_queue.put((gen_kwargs, prompt_length, future))
+        return await future
+
+    @staticmethod
+    @torch.inference_mode()
+    def _stream_generate(
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        gen_kwargs: Dict[str, Any],
+        channel: "TokenChannel",
+    ) -> None:
+        r"""
+        Runs the generation prepared by `_process_args`, streaming its text to `channel`.
+        """
+        gen_kwargs["streamer"] = _ChannelStreamer(channel, tokenizer, skip_prompt=True, skip_special_tokens=True)
+        gen_kwargs["stopping_criteria"] = StoppingCriteriaList([_ChannelClosed(channel)])
+        try:
+            model.generate(**gen_kwargs)
+        except Exception as e:
+            channel.put(e)
 
     @staticmethod
     @torch.inference_mode()
@@ -269,19 +413,43 @@ class HuggingfaceEngine(BaseEngine):
         tokenizer: "PreTrainedTokenizer",
         batch_input: List[str],
         input_kwargs: Optional[Dict[str, Any]] = {},
+        max_batch_tokens: int = 16384,
     ) -> List[float]:
+        r"""
+        Scores the inputs in micro-batches of similar lengths, each holding at most `max_batch_tokens` tokens
+        including padding (a longer input is scored alone). Scores are returned in the order of `batch_input`.
+        """
         max_length: Optional[int] = input_kwargs.pop("max_length", None)
         device = getattr(model.pretrained_model, "device", "cuda")
-        inputs: Dict[str, "torch.Tensor"] = tokenizer(
+        input_ids: List[List[int]] = tokenizer(
             batch_input,
-            padding=True,
             truncation=True,
             max_length=max_length or getattr(model.config, "max_position_embeddings", 1024),
-            return_tensors="pt",
             add_special_tokens=False,
-        ).to(device)
-        values: "torch.Tensor" = model(**inputs, return_dict=True, use_cache=False)[-1]
-        scores = values.gather(dim=-1, index=(inputs["attention_mask"].sum(dim=-1, keepdim=True) - 1))
+        )["input_ids"]
+        scores = [0.0] * len(input_ids)
+
+        def score(indices: List[int]) -> None:
+            inputs: Dict[str, "torch.Tensor"] = tokenizer.pad(
+                {"input_ids": [input_ids[idx] for idx in indices]}, return_tensors="pt"
+            ).to(device)
+            values: "torch.Tensor" = model(**inputs, return_dict=True, use_cache=False)[-1]
+            batch_scores = values.gather(dim=-1, index=(inputs["attention_mask"].sum(dim=-1, keepdim=True) - 1))
+            for idx, batch_score in zip(indices, batch_scores.squeeze(-1).tolist()):
+                scores[idx] = batch_score
+
+        batch: List[int] = []
+        for idx in sorted(range(len(input_ids)), key=lambda idx: len(input_ids[idx]), reverse=True):
+            # longest first, so the first input of a batch sets its padded length
+            if batch and (len(batch) + 1) * len(input_ids[batch[0]]) > max_batch_tokens:
+                score(batch)
+                batch = []
+
+            batch.append(idx)
+
+        if batch:
+            score(batch)
+
         return scores
 
     @override
@@ -311,9 +479,15 @@ class HuggingfaceEngine(BaseEngine):
             videos,
             input_kwargs,
         )
+        # templating and tokenization also run in the pool, off the event loop
+        gen_kwargs, prompt_length = await loop.run_in_executor(self.pool, self._process_args, *input_args)
+        if self.max_batch_size > 1 and set(gen_kwargs.keys()) == _BATCHABLE_KEYS:
+            return await self._submit_batched(gen_kwargs, prompt_length)
+
         async with self.semaphore:
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                return await loop.run_in_executor(pool, self._chat, *input_args)
+            return await loop.run_in_executor(
+                self.pool, self._generate, self.model, self.tokenizer, gen_kwargs, prompt_length
+            )
 
     @override
     async def stream_chat(
@@ -342,14 +516,22 @@ class HuggingfaceEngine(BaseEngine):
             videos,
             input_kwargs,
         )
+        gen_kwargs, prompt_length = await loop.run_in_executor(self.pool, self._process_args, *input_args)
+        if (
+            self.continuous_batcher is not None
+            and set(gen_kwargs.keys()) == _BATCHABLE_KEYS
+            and gen_kwargs["generation_config"].num_return_sequences == 1
+        ):
+            async for new_token in self.continuous_batcher.stream(gen_kwargs, prompt_length):
+                yield new_token
+
+            return
+
         async with self.semaphore:
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                stream = self._stream_chat(*input_args)
-                while True:
-                    try:
-                        yield await loop.run_in_executor(pool, stream)
-                    except StopAsyncIteration:
-                        break
+            channel = TokenChannel(loop)
+            loop.run_in_executor(self.pool, self._stream_generate, self.model, self.tokenizer, gen_kwargs, channel)
+            async for new_token in channel.stream():  # all the text decoded since the last wake-up
+                yield new_token
 
     @override
     async def get_scores(
@@ -361,7 +543,6 @@ class HuggingfaceEngine(BaseEngine):
             raise ValueError("Cannot get scores using an auto-regressive model.")
 
         loop = asyncio.get_running_loop()
-        input_args = (self.model, self.tokenizer, batch_input, input_kwargs)
+        input_args = (self.model, self.tokenizer, batch_input, input_kwargs, self.max_score_tokens)
         async with self.semaphore:
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                return await loop.run_in_executor(pool, self._get_scores, *input_args)
+            return await loop.run_in_executor(self.pool, self._get_scores, *input_args)
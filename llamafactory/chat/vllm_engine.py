@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import uuid
+from collections import OrderedDict
 from typing import TYPE_CHECKING, Any, AsyncGenerator, AsyncIterator, Dict, List, Optional, Sequence, Union
 
 from typing_extensions import override
@@ -82,7 +84,11 @@ class VllmEngine(BaseEngine):
             "enforce_eager": model_args.vllm_enforce_eager,
             "enable_lora": model_args.adapter_name_or_path is not None,
             "max_lora_rank": model_args.vllm_max_lora_rank,
+            "max_loras": model_args.vllm_max_loras,
         }
+        if model_args.adapter_name_or_path is not None:  # keep every adapter on the CPU, vLLM swaps them in (LRU)
+            engine_args["max_cpu_loras"] = max(len(model_args.adapter_name_or_path), model_args.vllm_max_loras)
+
         if isinstance(model_args.vllm_config, dict):
             engine_args.update(model_args.vllm_config)
 
@@ -93,10 +99,16 @@ class VllmEngine(BaseEngine):
             vllm.model_executor.models.llava.LlavaMultiModalProjector = LlavaMultiModalProjectorForYiVLForVLLM
 
         self.model = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**engine_args))
-        if model_args.adapter_name_or_path is not None:
-            self.lora_request = LoRARequest("default", 1, model_args.adapter_name_or_path[0])
-        else:
-            self.lora_request = None
+        # adapters are selected by their directory name, requests naming no adapter use the first one
+        self.lora_requests: Dict[str, "LoRARequest"] = OrderedDict()
+        for lora_id, adapter_path in enumerate(model_args.adapter_name_or_path or [], start=1):
+            name = os.path.basename(os.path.normpath(adapter_path))
+            if name in self.lora_requests:
+                name = f"{name}-{lora_id}"
+
+            self.lora_requests[name] = LoRARequest(name, lora_id, adapter_path)
+
+        self.lora_request = next(iter(self.lora_requests.values()), None)
 
     async def _generate(
         self,
@@ -126,6 +138,7 @@ class VllmEngine(BaseEngine):
         max_length: Optional[int] = input_kwargs.pop("max_length", None)
         max_new_tokens: Optional[int] = input_kwargs.pop("max_new_tokens", None)
         stop: Optional[Union[str, List[str]]] = input_kwargs.pop("stop", None)
+        adapter_name: Optional[str] = input_kwargs.pop("adapter_name", None)
 
         if length_penalty is not None:
             logger.warning_rank0("Length penalty is not supported by the vllm engine yet.")
@@ -178,7 +191,7 @@ class VllmEngine(BaseEngine):
             {"prompt_token_ids": prompt_ids, "multi_modal_data": multi_modal_data},
             sampling_params=sampling_params,
             request_id=request_id,
-            lora_request=self.lora_request,
+            lora_request=self.lora_requests.get(adapter_name, self.lora_request),
         )
         return result_generator
 
@@ -142,6 +142,10 @@ class VllmArguments:
         default=32,
         metadata={"help": "Maximum rank of all LoRAs in the vLLM engine."},
     )
+    vllm_max_loras: int = field(
+        default=1,
+        metadata={"help": "Maximum number of LoRAs in a single batch of the vLLM engine, the others wait on the CPU."},
+    )
     vllm_config: Optional[Union[dict, str]] = field(
         default=None,
         metadata={"help": "Config to initialize the vllm engine. Please use JSON strings."},
@@ -0,0 +1,163 @@
+import os
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class AdapterCapacityError(ValueError):
+    r"""
+    Raised when an adapter cannot be added because every slot is held by an adapter filling an arm.
+    """
+
+
+@dataclass
+class Adapter:
+    name: str
+    path: str
+    lora_id: int
+    request: Any  # the `LoRARequest` passed to the engine
+
+
+def _path_version(path: str) -> float:
+    # an adapter re-trained into the same directory gets a new id, so the engine never serves stale cached weights
+    if not os.path.isdir(path):
+        return 0.0
+    return max([os.path.getmtime(path)] + [entry.stat().st_mtime for entry in os.scandir(path)])
+
+
+class AdapterRegistry:
+    r"""
+    The LoRA adapters the study server can serve, and which adapter fills each study arm ("sft", "dpo").
+
+    Every adapter version (path and modification time) gets its own LoRA id, and ids are never reused, so the
+    engine cannot mix up the cached weights of two adapters. Adapters are preloaded into the engine when they are
+    added, and at most `max_loaded` are kept: beyond that the least recently used adapter that fills no arm is
+    retired (the engine's own LRU then drops its weights). Arms are switched atomically, so requests already
+    running finish with the adapter they started with.
+    """
+
+    def __init__(
+            self,
+            max_loaded: int = 4,
+            make_request: Optional[Callable[[str, int, str], Any]] = None,
+            preload: Optional[Callable[[Any], Awaitable[None]]] = None
+    ) -> None:
+        self.max_loaded = max_loaded
+        self.make_request = make_request or (lambda name, lora_id, path: (name, lora_id, path))
+        self.preload = preload
+        self.arms: Dict[str, str] = {}
+        self._adapters: "OrderedDict[str, Adapter]" = OrderedDict()  # least recently used first
+        self._ids: Dict[Tuple[str, float], int] = {}
+        self._lock = asyncio.Lock()
+
+    def register(self, name: str, path: str, arm: Optional[str] = None) -> Adapter:
+        """
+        Adds an adapter without preloading it, e.g. at import time; see `preload_all`.
+        """
+        snapshot = self._snapshot()
+        adapter = self._insert(name, path)
+        try:
+            self._make_room(name, arm)
+        except AdapterCapacityError:
+            self._restore(snapshot)
+            raise
+        if arm is not None:
+            self.arms[arm] = name
+        self._evict(keep=name)
+        return adapter
+
+    async def add(self, name: str, path: str, arm: Optional[str] = None) -> Adapter:
+        """
+        Registers and preloads an adapter, then assigns it to `arm` if given. A failed add (no free slot, or a failed
+        preload, e.g. a wrong path) leaves the registry unchanged.
+        """
+        if arm is not None and arm not in self.arms:
+            raise ValueError(f"Unknown arm {arm}, expected one of {list(self.arms)}.")
+        async with self._lock:
+            snapshot = self._snapshot()
+            adapter = self._insert(name, path)
+            try:
+                self._make_room(name, arm)
+                if self.preload is not None:
+                    await self.preload(adapter.request)
+            except BaseException:  # also a cancelled preload, e.g. on shutdown
+                self._restore(snapshot)
+                raise
+            if arm is not None:
+                self.arms[arm] = name
+            self._evict(keep=name)  # only once the new adapter is loaded
+            return adapter
+
+    async def assign(self, arm: str, name: str) -> None:
+        # under the lock, so a failed `add` does not roll the change back with its snapshot
+        async with self._lock:
+            if arm not in self.arms:
+                raise ValueError(f"Unknown arm {arm}, expected one of {list(self.arms)}.")
+            if name not in self._adapters:
+                raise KeyError(f"Adapter {name} is not registered.")
+            self.arms[arm] = name
+
+    async def retire(self, name: str) -> None:
+        async with self._lock:
+            if name in self.arms.values():
+                raise ValueError(f"Adapter {name} still fills an arm, assign another adapter first.")
+            if self._adapters.pop(name, None) is None:
+                raise KeyError(f"Adapter {name} is not registered.")
+
+    def resolve(self, arm: str) -> Adapter:
+        """
+        Returns the adapter currently filling `arm` and marks it as recently used.
+        """
+        adapter = self._adapters[self.arms[arm]]
+        self._adapters.move_to_end(adapter.name)
+        return adapter
+
+    async def preload_all(self) -> None:
+        for adapter in list(self._adapters.values()):
+            if self.preload is not None:
+                await self.preload(adapter.request)
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "arms": dict(self.arms),
+            "adapters": [
+                {"name": adapter.name, "path": adapter.path, "lora_id": adapter.lora_id}
+                for adapter in self._adapters.values()
+            ],
+            "max_loaded": self.max_loaded,
+        }
+
+    def _insert(self, name: str, path: str) -> Adapter:
+        if name in self._adapters and self._adapters[name].path != path:
+            raise ValueError(f"Adapter {name} is already registered with {self._adapters[name].path}.")
+        version = (path, _path_version(path))
+        lora_id = self._ids.setdefault(version, len(self._ids) + 1)
+        # the engine identifies adapters by name as well, so the name carries the id
+        adapter = Adapter(name, path, lora_id, self.make_request(f"{name}-{lora_id}", lora_id, path))
+        self._adapters[name] = adapter
+        self._adapters.move_to_end(name)
+        return adapter
+
+    def _evictable(self, keep: str, arm: Optional[str] = None) -> List[str]:
+        # adapters filling an arm (after `arm` switches to `keep`) and `keep` itself stay, least recently used first
+        arms = dict(self.arms, **({arm: keep} if arm is not None else {}))
+        return [name for name in self._adapters if name != keep and name not in arms.values()]
+
+    def _make_room(self, name: str, arm: Optional[str] = None) -> None:
+        if len(self._adapters) - len(self._evictable(name, arm)) > self.max_loaded:
+            raise AdapterCapacityError(
+                f"Cannot load {name}: all {self.max_loaded} adapter slots fill an arm, raise MAX_LOADED_ADAPTERS."
+            )
+
+    def _evict(self, keep: str) -> None:
+        for name in self._evictable(keep):
+            if len(self._adapters) <= self.max_loaded:
+                break
+            del self._adapters[name]
+
+    def _snapshot(self):
+        return OrderedDict(self._adapters), dict(self.arms), dict(self._ids)
+
+    def _restore(self, snapshot) -> None:
+        self._adapters, self.arms, self._ids = snapshot
@@ -0,0 +1,110 @@
+# A CPU-only stand-in for `user_interface.model_response`, used to benchmark the study app without a GPU.
+# Select it with `MODEL_BACKEND=fake`. Replies are deterministic given the conversation, and decoding is
+# simulated with `asyncio.sleep`, so the event loop behaves as it does with the async vLLM engine.
+
+import os
+import re
+import asyncio
+import hashlib
+from collections import Counter
+from typing import Any, AsyncGenerator, Dict, List
+from user_interface.adapter_registry import AdapterRegistry
+
+# Seconds before the first token and between tokens of every simulated generation.
+prefill_latency = float(os.environ.get("FAKE_PREFILL_LATENCY", "0.05"))
+token_latency = float(os.environ.get("FAKE_TOKEN_LATENCY", "0.005"))
+
+CANNED_REPLIES = [
+    "听起来这段时间你真的承受了很多，愿意多和我说说让你最难受的部分吗？",
+    "我能感受到你的失落和无助，这些感受都是可以被理解的。",
+    "你已经很努力地在面对这些事情了，现在最希望得到什么样的支持呢？",
+    "谢谢你愿意把这些告诉我，我们可以一起慢慢梳理。",
+    "这件事对你来说一定很重要，所以才会让你这么在意。",
+]
+CANNED_TRANSLATIONS = [
+    "It sounds like you have been carrying a lot lately. Would you tell me more about what hurts the most?",
+    "I can feel your disappointment and helplessness, and those feelings make sense.",
+    "You have been working hard to face all of this. What kind of support would help you most right now?",
+    "Thank you for sharing this with me. We can sort through it together, step by step.",
+    "This clearly matters a lot to you, which is why it weighs on you so much.",
+]
+
+retry_stats = Counter()
+# Adapters are only bookkept here, so the admin endpoints can be exercised without an engine.
+adapter_registry = AdapterRegistry()
+adapter_registry.register("sft", "fake/sft", arm="sft")
+adapter_registry.register("dpo", "fake/dpo", arm="dpo")
+
+
+def _pick(conversations: List[Dict[str, str]], name: str) -> int:
+    key = name + "".join(turn.get("content", "") for turn in conversations)
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16) % len(CANNED_REPLIES)
+
+
+async def _decode(text: str) -> AsyncGenerator[str, None]:
+    await asyncio.sleep(prefill_latency)
+    for char in text:
+        await asyncio.sleep(token_latency)
+        yield char
+
+
+async def _generate(text: str) -> str:
+    await asyncio.sleep(prefill_latency + token_latency * len(text))
+    return text
+
+
+async def get_model_response(conversations: List[Dict[str, str]]):
+    is_english = not re.search(r'[\u4e00-\u9fff]', conversations[-1]['content'])
+    retry_stats["requests"] += 2
+    adapters = {arm: adapter_registry.resolve(arm).name for arm in ("sft", "dpo")}
+    sft_idx, dpo_idx = _pick(conversations, "sft"), _pick(conversations, "dpo")
+    sft_output, dpo_output = await asyncio.gather(
+        _generate(CANNED_REPLIES[sft_idx]), _generate(CANNED_REPLIES[dpo_idx])
+    )
+    if is_english:
+        translated_content = await _generate(CANNED_REPLIES[_pick(conversations, "user")])
+        sft, dpo = await asyncio.gather(
+            _generate(CANNED_TRANSLATIONS[sft_idx]), _generate(CANNED_TRANSLATIONS[dpo_idx])
+        )
+        return {
+            "sft": sft, "dpo": dpo, "is_english": is_english,
+            "chinese_sft": sft_output, "chinese_dpo": dpo_output,
+            "translated_content": translated_content, "adapters": adapters
+        }
+    else:
+        return {"sft": sft_output, "dpo": dpo_output, "is_english": is_english, "adapters": adapters}
+
+
+async def stream_model_response(
+        conversations: List[Dict[str, str]], hide_reasoning: bool = True
+) -> AsyncGenerator[Dict[str, Any], None]:
+    is_english = not re.search(r'[\u4e00-\u9fff]', conversations[-1]['content'])
+    retry_stats["requests"] += 2
+    adapters = {arm: adapter_registry.resolve(arm).name for arm in ("sft", "dpo")}
+    indices = {"sft": _pick(conversations, "sft"), "dpo": _pick(conversations, "dpo")}
+    replies = CANNED_TRANSLATIONS if is_english else CANNED_REPLIES
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce(name: str):
+        async for char in _decode(replies[indices[name]]):
+            await queue.put({"event": "token", "model": name, "text": char})
+        await queue.put(None)
+
+    producers = [asyncio.create_task(produce(name)) for name in indices]
+    finished = 0
+    while finished < len(producers):
+        event = await queue.get()
+        if event is None:
+            finished += 1
+        else:
+            yield event
+
+    response = {name: replies[idx] for name, idx in indices.items()}
+    response["is_english"] = is_english
+    response["adapters"] = adapters
+    if is_english:
+        response.update({
+            "chinese_sft": CANNED_REPLIES[indices["sft"]], "chinese_dpo": CANNED_REPLIES[indices["dpo"]],
+            "translated_content": CANNED_REPLIES[_pick(conversations, "user")]
+        })
+    yield {"event": "done", "response": response}
@@ -2,7 +2,7 @@ import random
 import yaml
 from pathlib import Path
 from fire import Fire
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Sequence
 import logging
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -11,58 +11,82 @@ from llamafactory.model import load_model, load_tokenizer
 from llamafactory.data import get_template_and_fix_tokenizer
 from utils.message_utils import Message
 from utils.config_utils import *
-from utils.template_utils import get_template
+from utils.template_utils import get_template, SegmentEncoder, HistoryManager
+from utils.persona_utils import load_personas
+from utils.generation_utils import REPLY_MARKER, USER_MARKER, KVCacheSession
+from utils.generation_utils import marker_stopping_criteria, split_turn, turn_stop_strings
 
 logging.getLogger().setLevel(logging.INFO)
 
 
+@torch.inference_mode()
+def generate_batch(model, tokenizer, batch_ids: List[List[int]], **generation_kwargs) -> List[str]:
+    r"""
+    Generates one continuation per prompt in a single left-padded `generate` call and returns the decoded texts.
+    """
+    max_length = max(len(ids) for ids in batch_ids)
+    input_ids = torch.full((len(batch_ids), max_length), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for row, ids in enumerate(batch_ids):
+        input_ids[row, max_length - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, max_length - len(ids):] = 1
+    output_ids = model.generate(
+        input_ids=input_ids.to(model.device),
+        attention_mask=attention_mask.to(model.device),
+        pad_token_id=tokenizer.pad_token_id,
+        **generation_kwargs
+    )
+    return [text.strip() for text in tokenizer.batch_decode(output_ids[:, max_length:], skip_special_tokens=True)]
+
+
 class UserSimulator:
-    def __init__(self, args: Optional[Dict[str, Any]] = None) -> None:
+    generation_kwargs = dict(max_new_tokens=256, temperature=1.0, top_k=50, top_p=0.95, do_sample=True)
+    marker = USER_MARKER
+    stop_strings = turn_stop_strings('user')
+
+    def __init__(self, args: Optional[Dict[str, Any]] = None, with_model: bool = True) -> None:
         self.model_args, self.data_args, self.eval_args, fine_tuning_args = get_eval_args(args)
         self.tokenizer = load_tokenizer(self.model_args)["tokenizer"]
         self.tokenizer.padding_side = "right"
         self.template = get_template_and_fix_tokenizer(self.tokenizer, self.data_args)
-        self.model = load_model(self.tokenizer, self.model_args, fine_tuning_args)
+        # without the model, only prompts are built (e.g. when vLLM generates them)
+        self.model = load_model(self.tokenizer, self.model_args, fine_tuning_args) if with_model else None
         self.user_template = get_template('user_simulator')
-        self.description_list = self.__init_desc__()
+        self.history = HistoryManager(self.tokenizer, self.data_args.cutoff_len, template=self.user_template)
+        self.encoder = SegmentEncoder(self.template, self.tokenizer)
+        self.personas = self.__init_desc__()
 
-    def __init_desc__(self):
+    def __init_desc__(self, attributes: Sequence[str] = ()):
+        # a memory-mapped index of the descriptions, built on first use, instead of loading the whole dataset
         dataset_path = os.path.join(self.data_args.dataset_dir, f"{self.data_args.dataset_name}.json")
-        raw_data = json.load(open(dataset_path, 'r', encoding='utf-8'))
-        description_list = [line['description'] for line in raw_data]
-        return description_list
-
-    @torch.inference_mode()
-    def __respond__(self, input_message: List[Dict[str, str]]) -> str:
-        input_ids = self.template.encode_oneturn(tokenizer=self.tokenizer, messages=input_message)[0]
-        input_ids = torch.tensor(input_ids).unsqueeze(0).to(self.model.device)
-        output_ids = self.model.generate(
-            input_ids=input_ids,
-            attention_mask=torch.ones_like(input_ids),
-            max_new_tokens=256,  # Maximum length of the generated text
-            num_return_sequences=1,  # Number of sequences per input
-            temperature=1.0,  # Sampling temperature
-            top_k=50,  # Top-k sampling
-            top_p=0.95,  # Top-p (nucleus sampling)
-            do_sample=True,  # Enable sampling
-        )[0]
-        input_length = (input_ids != self.tokenizer.pad_token_id).sum(dim=1)  # Shape: [batch_size]
-        new_tokens = output_ids[input_length:].tolist()
-
-        # Decode the newly generated tokens
-        generated_text = self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
-        print(generated_text.split('【来访者对话】：')[0])
-        generated_text = generated_text.split('【来访者对话】：')[-1]
+        return load_personas(dataset_path, attributes)
+
+    def encode(self, description: str, conversation: List[Dict[str, str]]) -> List[int]:
+        conversation = self.history.truncate(conversation, reserved_tokens=self.history.count_text(description))
+        segments = self.user_template.format_segments({'description': description, 'conversation': conversation})
+        return self.encoder.encode(segments)
+
+    def stopping_kwargs(self) -> Dict[str, Any]:
+        # decoding ends with the turn instead of running on into the next one
+        stopping_criteria = marker_stopping_criteria(self.tokenizer, self.marker, self.stop_strings)
+        return dict(self.generation_kwargs, stopping_criteria=stopping_criteria)
+
+    def __respond__(self, input_ids: List[int], session: Optional[KVCacheSession] = None) -> str:
+        if session is not None:
+            generated_text = session.generate(input_ids, **self.stopping_kwargs())
+        else:
+            generated_text = generate_batch(self.model, self.tokenizer, [input_ids], **self.stopping_kwargs())[0]
+        reasoning, generated_text = split_turn(generated_text, self.marker, self.stop_strings)
+        print(reasoning)
         return generated_text
 
     def interact(self) -> None:
-        user_description = random.choice(self.description_list)
+        user_description = self.personas.sample()['description']
         conversation = []
+        session = KVCacheSession(self.model, self.tokenizer)
 
         while True:
-            input_dict = {'description': user_description, 'conversation': conversation}
-            input_text = self.user_template.format_example(input_dict)
-            user_response = self.__respond__(input_text)
+            user_response = self.__respond__(self.encode(user_description, conversation), session)
             print(user_response)
             therapist = input('倾听者：')
             conversation.append({'role': 'user', 'content': user_response})
@@ -73,56 +97,170 @@ class UserSimulator:
 
 
 class EmpatheticLLM:
-    def __init__(self, args: Optional[Dict[str, Any]] = None) -> None:
+    generation_kwargs = dict(max_new_tokens=512, temperature=1.0, top_k=50, top_p=0.95, do_sample=True)
+    marker = REPLY_MARKER
+    stop_strings = turn_stop_strings('assistant')
+
+    def __init__(self, args: Optional[Dict[str, Any]] = None, with_model: bool = True) -> None:
         self.model_args, self.data_args, self.eval_args, fine_tuning_args = get_eval_args(args)
         self.tokenizer = load_tokenizer(self.model_args)["tokenizer"]
         self.tokenizer.padding_side = "right"
         self.template = get_template_and_fix_tokenizer(self.tokenizer, self.data_args)
-        self.model = load_model(self.tokenizer, self.model_args, fine_tuning_args)
+        self.model = load_model(self.tokenizer, self.model_args, fine_tuning_args) if with_model else None
         self.llm_template = get_template('empathetic_llm')
+        self.history = HistoryManager(self.tokenizer, self.data_args.cutoff_len, template=self.llm_template)
+        self.encoder = SegmentEncoder(self.template, self.tokenizer)
 
-    @torch.inference_mode()
-    def __respond__(self, input_message: List[Dict[str, str]]) -> str:
-        input_message = self.llm_template.format_example({'conversation': input_message})
-        input_ids = self.template.encode_oneturn(tokenizer=self.tokenizer, messages=input_message)[0]
-        input_ids = torch.tensor(input_ids).unsqueeze(0).to(self.model.device)
-        while True:
-            output_ids = self.model.generate(
-                input_ids=input_ids,
-                attention_mask=torch.ones_like(input_ids),
-                max_new_tokens=512,  # Maximum length of the generated text
-                num_return_sequences=1,  # Number of sequences per input
-                temperature=1.0,  # Sampling temperature
-                top_k=50,  # Top-k sampling
-                top_p=0.95,  # Top-p (nucleus sampling)
-                do_sample=True,  # Enable sampling
-            )[0]
-            input_length = (input_ids != self.tokenizer.pad_token_id).sum(dim=1)  # Shape: [batch_size]
-            new_tokens = output_ids[input_length:].tolist()
-
-            # Decode the newly generated tokens
-            generated_text = self.tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
-            # print(generated_text.split('【倾听者回复】：')[0])
-            try:
-                generated_text = generated_text.split('【倾听者回复】：')[-1]
-                break
-            except IndexError:
-                continue
-        return generated_text
+    def encode(self, conversation: List[Dict[str, str]]) -> List[int]:
+        segments = self.llm_template.format_segments({'conversation': self.history.truncate(conversation)})
+        return self.encoder.encode(segments)
+
+    def stopping_kwargs(self) -> Dict[str, Any]:
+        stopping_criteria = marker_stopping_criteria(self.tokenizer, self.marker, self.stop_strings)
+        return dict(self.generation_kwargs, stopping_criteria=stopping_criteria)
+
+    def __respond__(self, input_ids: List[int], session: Optional[KVCacheSession] = None) -> str:
+        if session is not None:
+            generated_text = session.generate(input_ids, **self.stopping_kwargs())
+        else:
+            generated_text = generate_batch(self.model, self.tokenizer, [input_ids], **self.stopping_kwargs())[0]
+        # print(split_turn(generated_text, self.marker)[0])
+        return split_turn(generated_text, self.marker, self.stop_strings)[1]
 
     def interact(self) -> None:
         conversation = []
+        session = KVCacheSession(self.model, self.tokenizer)
         while True:
             user_response = input('用户：')
             conversation.append({'role': 'user', 'content': user_response})
-            input_dict = {'conversation': conversation}
-            input_text = self.llm_template.format_example(input_dict)
-            therapist = self.__respond__(input_text)
-            output_text = therapist.split('【倾听者回复】：')[-1]
+            therapist = self.__respond__(self.encode(conversation), session)
+            output_text = therapist.split(REPLY_MARKER)[-1]
             print('咨询师：', therapist)
             conversation.append({'role': 'assistant', 'content': output_text})
 
 
+class SelfPlayRollout:
+    r"""
+    Simulates many counselling sessions at once: `UserSimulator` personas talk to an `EmpatheticLLM` counsellor.
+
+    Up to `batch_size` sessions are active at a time and advance in lockstep, so each turn of every active session
+    is generated by one batched call per role: a left-padded HF `generate`, or a single `vllm.LLM.generate` over
+    the base model with both LoRA adapters. When a session reaches `max_turns` exchanges, it is written to the
+    output JSONL and the next persona takes its place.
+    """
+
+    def __init__(
+            self,
+            user_args: Dict[str, Any],
+            llm_args: Dict[str, Any],
+            backend: str = 'hf',
+            batch_size: Optional[int] = None,
+            max_turns: int = 10
+    ) -> None:
+        if backend not in ('hf', 'vllm'):
+            raise ValueError(f'Unknown backend: {backend}')
+        self.backend = backend
+        self.max_turns = max_turns
+        self.user = UserSimulator(user_args, with_model=backend == 'hf')
+        self.llm = EmpatheticLLM(llm_args, with_model=backend == 'hf')
+        self.batch_size = batch_size or (256 if backend == 'vllm' else self.user.eval_args.batch_size)
+        if backend == 'vllm':
+            self.__init_vllm__()
+
+    def __init_vllm__(self) -> None:
+        from vllm import LLM, SamplingParams
+        from vllm.lora.request import LoRARequest
+
+        base_path = self.user.model_args.model_name_or_path
+        if self.llm.model_args.model_name_or_path != base_path:
+            raise ValueError('The vLLM backend needs the user simulator and the counsellor to share a base model.')
+
+        adapter_paths = [self.user.model_args.adapter_name_or_path, self.llm.model_args.adapter_name_or_path]
+        for paths in adapter_paths:
+            if paths is None or len(paths) != 1:
+                raise ValueError('The vLLM backend needs exactly one LoRA adapter per role.')
+        ranks = [json.load(open(os.path.join(paths[0], 'adapter_config.json')))['r'] for paths in adapter_paths]
+
+        self.engine = LLM(
+            model=base_path, enable_lora=True, max_loras=2, max_lora_rank=max(ranks), enable_prefix_caching=True
+        )
+        self.user_lora = LoRARequest('user_simulator', 1, adapter_paths[0][0])
+        self.llm_lora = LoRARequest('empathetic_llm', 2, adapter_paths[1][0])
+        self.sampling_params = {
+            'user': SamplingParams(
+                temperature=1.0, top_k=50, top_p=0.95, max_tokens=256, stop=self.user.stop_strings
+            ),
+            'llm': SamplingParams(
+                temperature=1.0, top_k=50, top_p=0.95, max_tokens=512, stop=self.llm.stop_strings
+            ),
+        }
+
+    def __generate__(self, role: str, batch_ids: List[List[int]]) -> List[str]:
+        if self.backend == 'vllm':
+            lora_request = self.user_lora if role == 'user' else self.llm_lora
+            outputs = self.engine.generate(
+                [{'prompt_token_ids': ids} for ids in batch_ids], self.sampling_params[role],
+                lora_request=lora_request, use_tqdm=False
+            )
+            return [output.outputs[0].text.strip() for output in outputs]
+
+        agent = self.user if role == 'user' else self.llm
+        return generate_batch(agent.model, agent.tokenizer, batch_ids, **agent.stopping_kwargs())
+
+    def step(self, sessions: List[Dict[str, Any]]) -> None:
+        r"""
+        Adds one client turn and one counsellor turn to every session.
+        """
+        batch_ids = [self.user.encode(session['description'], session['conversation']) for session in sessions]
+        for session, text in zip(sessions, self.__generate__('user', batch_ids)):
+            reasoning, content = split_turn(text, self.user.marker, self.user.stop_strings)
+            session['conversation'].append({'role': 'user', 'content': content.strip(), 'reasoning': reasoning})
+
+        batch_ids = [self.llm.encode(session['conversation']) for session in sessions]
+        for session, text in zip(sessions, self.__generate__('llm', batch_ids)):
+            reasoning, content = split_turn(text, self.llm.marker, self.llm.stop_strings)
+            session['conversation'].append({'role': 'assistant', 'content': content.strip(), 'reasoning': reasoning})
+
+    def run(
+            self, output_path: str, num_dialogues: int = 100, seed: int = 42,
+            persona_filters: Optional[Dict[str, Any]] = None
+    ) -> None:
+        r"""
+        Rolls out `num_dialogues` sessions with personas drawn from the simulator dataset and appends them to
+        `output_path` as they finish, one JSON object per line. `persona_filters` restricts the personas to
+        indexed attribute values (see `utils.persona_utils`).
+        """
+        rng = random.Random(seed)
+        if persona_filters:
+            # reopen the index with the filtered attributes, it is rebuilt if it does not have them yet
+            self.user.personas.close()
+            self.user.personas = self.user.__init_desc__(list(persona_filters))
+        rows = self.user.personas.select(**(persona_filters or {}))
+        if len(rows) == 0:
+            raise ValueError(f'No persona matches {persona_filters}.')
+        personas = [int(rows[rng.randrange(len(rows))]) for _ in range(num_dialogues)]
+        active: List[Dict[str, Any]] = []
+        finished = 0
+        with open(output_path, 'a', encoding='utf-8') as file:
+            while personas or active:
+                while personas and len(active) < self.batch_size:
+                    description = self.user.personas.description(personas.pop())
+                    active.append({'description': description, 'conversation': []})
+                self.step(active)
+
+                remaining = []
+                for session in active:
+                    if len(session['conversation']) >= 2 * self.max_turns:
+                        file.write(json.dumps(session, ensure_ascii=False) + '\n')
+                        finished += 1
+                    else:
+                        remaining.append(session)
+                if len(remaining) < len(active):
+                    file.flush()
+                    logging.info(f'{finished}/{num_dialogues} dialogues finished.')
+                active = remaining
+
+
 def chat(model, tok, ques, history=[], **kw):
     iids = tok.apply_chat_template(
         history + [{'role': 'user', 'content': ques}],
@@ -171,5 +309,22 @@ def main(yaml_path: str = 'interactive_models/user_simulator.yaml') -> None:
     interact.interact()
 
 
+def rollout(
+        output_path: str,
+        user_yaml: str = 'interactive_models/user_simulator.yaml',
+        llm_yaml: str = 'interactive_models/empathetic_llm.yaml',
+        num_dialogues: int = 100,
+        max_turns: int = 10,
+        backend: str = 'hf',
+        batch_size: Optional[int] = None,
+        seed: int = 42,
+        persona_filters: Optional[Dict[str, Any]] = None
+) -> None:
+    user_args = yaml.safe_load(Path(user_yaml).read_text())
+    llm_args = yaml.safe_load(Path(llm_yaml).read_text())
+    engine = SelfPlayRollout(user_args, llm_args, backend=backend, batch_size=batch_size, max_turns=max_turns)
+    engine.run(output_path, num_dialogues=num_dialogues, seed=seed, persona_filters=persona_filters)
+
+
 if __name__ == '__main__':
     Fire(main)
@@ -1,25 +1,37 @@
-from fastapi import FastAPI, Form, Request, Response, HTTPException
+from fastapi import FastAPI, Form, Request, Response, HTTPException, Header
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse
+from fastapi.responses import JSONResponse, RedirectResponse, HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from pydantic import BaseModel
 import os.path
 import random
+import asyncio
 import json
 import time
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 import uvicorn
 
-from user_interface.model_response import get_model_response
+if os.environ.get("MODEL_BACKEND", "vllm") == "fake":  # CPU-only stand-in for benchmarks
+    from user_interface.fake_response import get_model_response, stream_model_response, retry_stats, adapter_registry
+else:
+    from user_interface.model_response import get_model_response, stream_model_response, retry_stats, adapter_registry
+from user_interface.session_store import SessionCache, SessionStore, turn_events
+from user_interface.adapter_registry import AdapterCapacityError
 
 # from vllm import LLM, SamplingParams
 # from peft import PeftModel
 # import torch
 
+# The `/admin` endpoints are disabled unless a token is set; requests send it in the `X-Admin-Token` header.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 users = json.load(open("./user_interface/users.json", "r"))
+SESSION_MAX_AGE = 3600  # Session expires after 1 hour
+session_store = SessionCache(
+    SessionStore(os.environ.get("DIALOGUE_DIR", "user_interface/dialogues")), ttl=SESSION_MAX_AGE
+)
 
 app = FastAPI()
 app.add_middleware(
@@ -27,7 +39,7 @@ app.add_middleware(
     secret_key="your_secret_key",  # Change this to a secure random value
     session_cookie="session_id",  # Name of the session cookie
     same_site="lax",  # Allows session persistence across requests
-    max_age=3600,  # Session expires after 1 hour
+    max_age=SESSION_MAX_AGE,
     https_only=False  # Set to True in production with HTTPS
 )
 app.add_middleware(
@@ -42,6 +54,23 @@ app.mount("/static", StaticFiles(directory="user_interface/static"), name="stati
 templates = Jinja2Templates(directory="./user_interface/templates")
 
 
+@app.on_event("startup")
+async def start_session_flusher():
+    """Persist queued session events in the background."""
+    asyncio.create_task(session_store.run())
+
+
+@app.on_event("startup")
+async def preload_adapters():
+    """Load the configured adapters before the first participant arrives."""
+    await adapter_registry.preload_all()
+
+
+@app.on_event("shutdown")
+async def flush_sessions():
+    await session_store.flush()
+
+
 @app.get("/")
 @app.get("/login")
 async def login_page(request: Request):
@@ -97,11 +126,10 @@ async def pre_questions(request: Request, question_answer: PreQuestionRequest):
         raise HTTPException(status_code=400, detail="At least one keyword is required.")
 
     prequestions = question_answer.dict()
-    json.dump(
-        {"username": username, "user_mode": user_mode, "start_time": start_time, "presurvey": prequestions,
-         "dialogue": [], "feedback": [], "ratings": []},
-        open(f"user_interface/dialogues/{username}_{start_time}.json", "w"),
-        indent=4
+    session_store.append(
+        f"{username}_{start_time}",
+        {"type": "session", "username": username, "user_mode": user_mode, "start_time": start_time},
+        {"type": "presurvey", "presurvey": prequestions}
     )
 
 
@@ -129,12 +157,10 @@ async def dashboard(request: Request):
                 window.location.href = "/";
             </script>
             """, status_code=403)
-    if not os.path.exists(f"user_interface/dialogues/{username}_{start_time}.json"):
-        json.dump(
-            {"username": username, "user_mode": user_mode, "start_time": start_time, "dialogue": [], "feedback": [],
-             "ratings": []},
-            open(f"user_interface/dialogues/{username}_{start_time}.json", "w"),
-            indent=4
+    if not session_store.exists(f"{username}_{start_time}"):
+        session_store.append(
+            f"{username}_{start_time}",
+            {"type": "session", "username": username, "user_mode": user_mode, "start_time": start_time}
         )
 
     # if user_mode == "member":
@@ -158,51 +184,65 @@ async def chatbot_api(request: Request, message: str = Form(...)):
     start_time = request.session.get("start_time", current_time)
     # Save dialogue history
 
-    dialogue_path = f"user_interface/dialogues/{username}_{start_time}.json"
-
-    try:
-        with open(dialogue_path, "r") as file:
-            dialogue = json.load(file)
-    except FileNotFoundError:
-        dialogue = {"dialogue": []}
-
-    dialogue["dialogue"].append({"role": "user", "content": message, "time": current_time})
+    session_id = f"{username}_{start_time}"
+    dialogue = session_store.load(session_id)
+    user_turn = {"role": "user", "content": message, "time": current_time}
+    conversation = dialogue["dialogue"] + [user_turn]
 
-    responses = get_model_response(dialogue["dialogue"])
+    responses = await get_model_response(conversation)
     # responses = {"dpo": "", "sft": ""}
     reply_options = [responses['dpo'], responses['sft']]
     random.shuffle(reply_options)
-    dialogue["dialogue"].append(
-        {"role": "assistant", "time": current_time, "sft": responses["sft"], "dpo": responses["dpo"]})
-    if responses.get("is_english", False):
-        dialogue["dialogue"][-2]["translated_content"] = responses["translated_content"]
-        dialogue["dialogue"][-1]["chinese_sft"] = responses["chinese_sft"]
-        dialogue["dialogue"][-1]["chinese_dpo"] = responses["chinese_dpo"]
+    session_store.append(session_id, *turn_events(user_turn, responses, current_time))
 
-    with open(dialogue_path, "w") as file:
-        json.dump(dialogue, file, indent=4)
+    return JSONResponse(content={"response_id": len(conversation) + 1, "reply_options": reply_options})
 
-    return JSONResponse(content={"response_id": len(dialogue["dialogue"]), "reply_options": reply_options})
+
+@app.post("/chat_stream")
+async def chatbot_stream_api(request: Request, message: str = Form(...), hide_reasoning: bool = Form(True)):
+    """Streams the two candidate responses token by token as newline-delimited JSON."""
+    current_time = datetime.now().strftime("%y-%m-%d-%H-%M-%S")
+    username = request.session.get("username", "anonymous")
+    start_time = request.session.get("start_time", current_time)
+    session_id = f"{username}_{start_time}"
+    dialogue = session_store.load(session_id)
+    user_turn = {"role": "user", "content": message, "time": current_time}
+    conversation = dialogue["dialogue"] + [user_turn]
+    # The client only sees option indices, so shuffle which model fills which option.
+    options = ["dpo", "sft"]
+    random.shuffle(options)
+
+    async def event_stream():
+        responses = None
+        async for event in stream_model_response(conversation, hide_reasoning=hide_reasoning):
+            if event["event"] == "done":
+                responses = event["response"]
+            else:
+                chunk = {"event": event["event"], "option": options.index(event["model"]), "text": event["text"]}
+                yield json.dumps(chunk, ensure_ascii=False) + "\n"
+
+        session_store.append(session_id, *turn_events(user_turn, responses, current_time))
+
+        chunk = {
+            "event": "done",
+            "response_id": len(conversation) + 1,
+            "reply_options": [responses[name] for name in options]
+        }
+        yield json.dumps(chunk, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
 
 
 @app.post("/selected_response")
-async def selected_response(request: Request, message: str = Form(...)):
+async def selected_response(request: Request, message: str = Form(...), response_id: str = Form(None)):
     current_time = datetime.now().strftime("%y-%m-%d-%H-%M-%S")
     username = request.session.get("username", "anonymous")
     start_time = request.session.get("start_time", "")
-    dialogue_path = f"user_interface/dialogues/{username}_{start_time}.json"
-    try:
-        with open(dialogue_path, "r") as file:
-            dialogue = json.load(file)
-            dialogue["dialogue"][-1]["content"] = message
-    except FileNotFoundError:
-        dialogue = {"dialogue": []}
-        dialogue["dialogue"].append({"content": message, "time": current_time})
-
-    with open(dialogue_path, "w") as file:
-        json.dump(dialogue, file, indent=4)
+    session_store.append(
+        f"{username}_{start_time}", {"type": "selected", "content": message, "time": current_time}
+    )
 
-    return JSONResponse(content={"response_id": len(dialogue["dialogue"]), "reply": message})
+    return JSONResponse(content={"response_id": response_id, "reply": message})
 
 
 # Collect user feedback
@@ -213,9 +253,10 @@ async def collect_feedback(request: Request, response_id: str = Form(...), feedb
     username = request.session.get("username", "")
     start_time = request.session.get("start_time", "")
     current_time = datetime.fromtimestamp(time.time()).strftime("%y-%m-%d-%H-%M-%S")
-    feedbacks = json.load(open(f"user_interface/dialogues/{username}_{start_time}.json", "r"))
-    feedbacks["feedback"].append({"response_id": response_id, "feedback": feedback, "time": current_time})
-    json.dump(feedbacks, open(f"user_interface/dialogues/{username}_{start_time}.json", "w"), indent=4)
+    session_store.append(
+        f"{username}_{start_time}",
+        {"type": "feedback", "feedback": {"response_id": response_id, "feedback": feedback, "time": current_time}}
+    )
     return JSONResponse(content={"message": "Feedback received!"})
 
 
@@ -226,9 +267,10 @@ async def collect_rating(request: Request, response_id: str = Form(...), rating:
     username = request.session.get("username", "")
     start_time = request.session.get("start_time", "")
     current_time = datetime.fromtimestamp(time.time()).strftime("%y-%m-%d-%H-%M-%S")
-    ratings = json.load(open(f"user_interface/dialogues/{username}_{start_time}.json", "r"))
-    ratings["ratings"].append({"response_id": response_id, "rating": rating, "time": current_time})
-    json.dump(ratings, open(f"user_interface/dialogues/{username}_{start_time}.json", "w"), indent=4)
+    session_store.append(
+        f"{username}_{start_time}",
+        {"type": "rating", "rating": {"response_id": response_id, "rating": rating, "time": current_time}}
+    )
     return JSONResponse(content={"message": "Feedback received!"})
 
 
@@ -270,14 +312,14 @@ async def collect_survey(response: SurveyResponse, request: Request):
     print(f"User: {username}, Client IP: {request.client.host}")
     print("Survey Data:", response.dict())
 
-    user_content = json.load(open(f"user_interface/dialogues/{username}_{start_time}.json", "r"))
-    user_content["post-survey"] = {
+    post_survey = {
         "calm_excited": response.calm_excited,
         "unpleasant_pleasant": response.unpleasant_pleasant,
         "supportiveness": response.supportiveness,
         "engagement": response.engagement
     }
-    json.dump(user_content, open(f"user_interface/dialogues/{username}_{start_time}.json", "w"), indent=4)
+    session_store.append(f"{username}_{start_time}", {"type": "post_survey", "post_survey": post_survey})
+    await session_store.close(f"{username}_{start_time}")
 
     # ✅ Clear session data
     request.session.clear()
@@ -286,9 +328,77 @@ async def collect_survey(response: SurveyResponse, request: Request):
     return JSONResponse(content={"message": "Thank you for your paticipance!", "success": True}, status_code=200)
 
 
+@app.get("/model_stats")
+async def model_stats():
+    """Report how often the reply marker was missing and generations had to be retried."""
+    return JSONResponse(content=dict(retry_stats))
+
+
+class AdapterRequest(BaseModel):
+    name: str
+    path: str
+    arm: Optional[str] = None
+
+
+class ArmRequest(BaseModel):
+    arm: str
+    adapter: str
+
+
+def check_admin(token: Optional[str]):
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin access denied.")
+
+
+@app.get("/admin/adapters")
+async def list_adapters(x_admin_token: Optional[str] = Header(None)):
+    """List the registered adapters and the adapter filling each arm."""
+    check_admin(x_admin_token)
+    return JSONResponse(content=adapter_registry.describe())
+
+
+@app.post("/admin/adapters")
+async def add_adapter(data: AdapterRequest, x_admin_token: Optional[str] = Header(None)):
+    """Load an adapter without a restart, optionally switching an arm to it once it is loaded."""
+    check_admin(x_admin_token)
+    try:
+        await adapter_registry.add(data.name, data.path, data.arm)
+    except AdapterCapacityError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cannot load adapter {data.name}: {e}")
+    return JSONResponse(content=adapter_registry.describe())
+
+
+@app.post("/admin/arms")
+async def assign_arm(data: ArmRequest, x_admin_token: Optional[str] = Header(None)):
+    """Switch an arm to a registered adapter; turns already being generated keep their adapter."""
+    check_admin(x_admin_token)
+    try:
+        await adapter_registry.assign(data.arm, data.adapter)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content=adapter_registry.describe())
+
+
+@app.delete("/admin/adapters/{name}")
+async def retire_adapter(name: str, x_admin_token: Optional[str] = Header(None)):
+    """Retire an adapter that no longer fills an arm."""
+    check_admin(x_admin_token)
+    try:
+        await adapter_registry.retire(name)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content=adapter_registry.describe())
+
+
 @app.get("/logout")
 async def logout(request: Request, response: Response):
     """Clear session and redirect to login page."""
+    username = request.session.get("username", "")
+    start_time = request.session.get("start_time", "")
+    if username and session_store.exists(f"{username}_{start_time}"):
+        await session_store.close(f"{username}_{start_time}")
     request.session.clear()  # ✅ Remove session data
     response.delete_cookie("session_id")  # ✅ Delete session cookie
     # return RedirectResponse(url="/")
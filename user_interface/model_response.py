@@ -1,14 +1,21 @@
 import json
+import uuid
 import torch
 import random
+import asyncio
+import hashlib
+import logging
+from collections import Counter, OrderedDict
 from transformers import AutoTokenizer
 from llamafactory.hparams import DataArguments
 from llamafactory.data import get_template_and_fix_tokenizer, Role
-from typing import Dict, List
-from vllm import LLM
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+from vllm import AsyncEngineArgs, AsyncLLMEngine
 from vllm import SamplingParams
 from vllm.lora.request import LoRARequest
-from utils.template_utils import get_template
+from utils.template_utils import get_template, SegmentEncoder, HistoryManager
+from utils.generation_utils import REPLY_MARKER, MarkerStreamParser, turn_stop_strings
+from user_interface.adapter_registry import AdapterRegistry
 import re
 
 model_info = json.load(open("user_interface/model.json", "r"))
@@ -16,13 +23,38 @@ model_info = json.load(open("user_interface/model.json", "r"))
 model_name_or_path = model_info["MODEL_PATH"]
 sft_lora_path = model_info["SFT_LORA_PATH"]
 dpo_lora_path = model_info["DPO_LORA_PATH"]
+# Resampling budget for outputs that lack the reply marker: each attempt draws `NUM_SAMPLES` candidates
+# in one request, and after `MAX_RETRIES` failed attempts the reply is forced to start after the marker.
+max_retries = model_info.get("MAX_RETRIES", 2)
+num_samples = model_info.get("NUM_SAMPLES", 2)
+# "incremental" tokenizes the prompt turn by turn, so consecutive turns share an exact token prefix
+# that the engine's prefix cache can reuse; "full" tokenizes the whole prompt at once.
+prompt_mode = model_info.get("PROMPT_MODE", "full")
+translation_cache_size = model_info.get("TRANSLATION_CACHE_SIZE", 4096)
+max_history_tokens = model_info.get("MAX_HISTORY_TOKENS", 4096)
+keep_last_turns = model_info.get("KEEP_LAST_TURNS", 5)
+# Adapter outputs stop where the next client turn would start, instead of decoding up to `max_tokens`.
+stop_strings = model_info.get("STOP_STRINGS", turn_stop_strings("assistant"))
+# Adapters kept addressable at once; more can be added and retired at runtime through `/admin/adapters`.
+max_loaded_adapters = model_info.get("MAX_LOADED_ADAPTERS", 4)
+max_loras = 2  # the sft and dpo arms
+if max_loaded_adapters < max_loras:
+    raise ValueError(f"MAX_LOADED_ADAPTERS must be at least {max_loras}, one adapter per arm.")
 
-model = LLM(
+logger = logging.getLogger(__name__)
+
+# The async engine runs continuous batching in the serving event loop, so concurrent `/chat` requests
+# from different participants share decode steps instead of blocking each other.
+model = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
     model=model_name_or_path,
     enable_lora=True,
+    max_loras=max_loras,  # keep both arms resident so they can share one batch
+    max_cpu_loras=max_loaded_adapters,
     tensor_parallel_size=torch.cuda.device_count(),
-    swap_space=1
-)
+    swap_space=1,
+    enable_prefix_caching=True,  # reuse the KV blocks of the dialogue history across turns
+    disable_log_requests=True
+))
 tokenizer = AutoTokenizer.from_pretrained(
     model_name_or_path,
     use_fast=True,
@@ -34,72 +66,329 @@ data_args = DataArguments()
 data_args.template = 'qwen2.5'
 template = get_template_and_fix_tokenizer(tokenizer, data_args)
 input_template = get_template("empathetic_llm")
+segment_encoder = SegmentEncoder(template, tokenizer)
+history_manager = HistoryManager(tokenizer, max_history_tokens, keep_last=keep_last_turns, template=input_template)
+marker_ids = tokenizer.encode(REPLY_MARKER, add_special_tokens=False)
+# Counts of adapter requests, extra attempts, discarded samples and forced continuations.
+retry_stats = Counter()
+generation_kwargs = {
+    "max_tokens": 512,
+    "top_k": 50,
+    "top_p": 0.9,
+    "temperature": 0.9
+}
+reply_kwargs = dict(generation_kwargs, stop=stop_strings)
 
 
-@torch.inference_mode()
-def infer_model(message_ids, lora_path: str = None):
-    while True:
-        generation_kwargs = {
-            "max_tokens": 512,
-            "top_k": 50,
-            "top_p": 0.9,
-            "temperature": 0.9
-        }
-        if lora_path:
-            outputs = model.generate(
-                prompt_token_ids=message_ids,
-                sampling_params=SamplingParams(seed=random.randint(0, 4096), **generation_kwargs),
-                lora_request=LoRARequest('default', 2, lora_path=lora_path)
-            )
-            generated = outputs[0].outputs[0].text
-            if "【倾听者回复】：" in generated:
-                generated = generated.split("【倾听者回复】：")[-1]
+async def preload_adapter(lora_request: LoRARequest):
+    """
+    Loads an adapter into the engine with a one-token request, so its first participant does not wait for it.
+    """
+    await generate(marker_ids, SamplingParams(max_tokens=1), lora_request)
+
+
+adapter_registry = AdapterRegistry(
+    max_loaded=max_loaded_adapters,
+    make_request=lambda name, lora_id, path: LoRARequest(name, lora_id, lora_path=path),
+    preload=preload_adapter
+)
+adapter_registry.register("sft", sft_lora_path, arm="sft")
+adapter_registry.register("dpo", dpo_lora_path, arm="dpo")
+
+
+async def generate(
+        message_ids: List[int], sampling_params: SamplingParams, lora_request: Optional[LoRARequest] = None
+):
+    """
+    Submits one request to the async engine and waits for its final output.
+    """
+    final_output = None
+    async for request_output in model.generate(
+            {"prompt_token_ids": message_ids},
+            sampling_params=sampling_params,
+            request_id=f"chat-{uuid.uuid4().hex}",
+            lora_request=lora_request
+    ):
+        final_output = request_output
+    return final_output
+
+
+async def stream_generate(
+        message_ids: List[int], sampling_params: SamplingParams, lora_request: Optional[LoRARequest] = None
+):
+    """
+    Submits one request to the async engine and yields the newly decoded text of its first sample.
+    """
+    generated_text = ""
+    async for request_output in model.generate(
+            {"prompt_token_ids": message_ids},
+            sampling_params=sampling_params,
+            request_id=f"chat-{uuid.uuid4().hex}",
+            lora_request=lora_request
+    ):
+        delta_text = request_output.outputs[0].text[len(generated_text):]
+        generated_text = request_output.outputs[0].text
+        if delta_text:
+            yield delta_text
+
+
+async def infer_model(message_ids, lora_request: Optional[LoRARequest] = None) -> str:
+    if lora_request is None:
+        output = await generate(
+            message_ids[0], SamplingParams(seed=random.randint(0, 4096), **generation_kwargs)
+        )
+        return output.outputs[0].text.replace("\n", "")
+
+    retry_stats["requests"] += 1
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            retry_stats["retries"] += 1
+        output = await generate(
+            message_ids[0], SamplingParams(n=num_samples, seed=random.randint(0, 4096), **reply_kwargs),
+            lora_request
+        )
+        for completion in output.outputs:
+            if REPLY_MARKER in completion.text:
+                generated = completion.text.split(REPLY_MARKER)[-1]
                 return generated.replace("\n", "")
-        else:
-            outputs = model.generate(
-                prompt_token_ids=message_ids,
-                sampling_params=SamplingParams(seed=random.randint(0, 4096), **generation_kwargs)
-            )
-            generated = outputs[0].outputs[0].text
-            return generated.replace("\n", "")
+        retry_stats["malformed_samples"] += len(output.outputs)
 
+    # Out of budget: continue from a prompt that already ends in the marker, so the output is the reply itself.
+    retry_stats["fallbacks"] += 1
+    logger.warning(f"No reply marker from {lora_request.lora_name} after {max_retries + 1} attempts, forcing the reply.")
+    output = await generate(
+        message_ids[0] + marker_ids, SamplingParams(seed=random.randint(0, 4096), **reply_kwargs), lora_request
+    )
+    generated = output.outputs[0].text.split(REPLY_MARKER)[-1]
+    return generated.replace("\n", "")
 
-def translate(text, to_english=True):
+
+def _translation_ids(text, to_english=True):
     if to_english:
         message = [{'content': f'把以下的文字翻译成英文：\n\n{text}\n\n只输出英文即可。\n', 'role': 'user'},
                    {'content': '', 'role': 'assistant'}]
-        message_id = [template.encode_oneturn(tokenizer=tokenizer, messages=message)[0]]
-        output = infer_model(message_id)
-        return output
     else:
         message = [{'content': f'把以下的文字翻译成中文：\n\n{text}\n\n只输出中文即可。\n', 'role': 'user'},
                    {'content': '', 'role': 'assistant'}]
-        message_id = [template.encode_oneturn(tokenizer=tokenizer, messages=message)[0]]
-        output = infer_model(message_id)
-        return output
+    return [template.encode_oneturn(tokenizer=tokenizer, messages=message)[0]]
 
 
-def get_model_response(conversations: List[Dict[str, str]]):
-    is_english = not re.search(r'[\u4e00-\u9fff]', conversations[-1]['content'])
-    if is_english:
-        translated_content = translate(conversations[-1]['content'], to_english=False)
+# LRU of finished translations keyed by a hash of the direction and the text. Participants often repeat
+# phrases, and the same reply options are translated again when they are re-shown.
+translation_cache: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _translation_key(text, to_english=True):
+    return hashlib.sha256(f"{'en' if to_english else 'zh'}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _cache_translation(key, translation):
+    translation_cache[key] = translation
+    translation_cache.move_to_end(key)
+    while len(translation_cache) > translation_cache_size:
+        translation_cache.popitem(last=False)
+
+
+async def translate(text, to_english=True):
+    key = _translation_key(text, to_english)
+    if key in translation_cache:
+        translation_cache.move_to_end(key)
+        return translation_cache[key]
+    output = await infer_model(_translation_ids(text, to_english))
+    _cache_translation(key, output)
+    return output
+
+
+def _model_conversations(conversations: List[Dict[str, str]], is_english: bool):
+    if not is_english:
+        return conversations
+    return [
+        {"content": turn.get("translated_content", turn["content"]) if idx % 2 == 0 else turn["content"],
+         "role": turn["role"]}
+        for idx, turn in enumerate(conversations)
+    ]
+
+
+async def _prepare_prompt(conversations: List[Dict[str, str]], is_english: bool):
+    """
+    Returns the prompt ids and the translated user message (None for Chinese input). The forward
+    translation is submitted first, and the history is tokenized while it is being generated.
+    """
+    if not is_english:
+        translation, translated_content = None, None
+    else:
+        translation = asyncio.create_task(translate(conversations[-1]['content'], to_english=False))
+        await asyncio.sleep(0)  # let the translation request reach the engine
+
+    history = _model_conversations(conversations[:-1], is_english)
+    if prompt_mode == "incremental":
+        # fill the segment cache while the translation runs; turns seen in earlier requests are already cached
+        for segment in input_template.format_segments({"conversation": history})[:-1]:
+            segment_encoder.segment_ids(segment)
+
+    if translation is not None:
+        translated_content = await translation
         conversations[-1]['translated_content'] = translated_content
-        conversations = [
-            {"content": turn["translated_content"] if idx % 2 == 0 else turn["content"], "role": turn["role"]}
-            for idx, turn in enumerate(conversations)
-        ]
 
+    conversations = history + _model_conversations(conversations[-1:], is_english)
+    start = history_manager.window(conversations)
+    conversations = conversations[start:]
+    if prompt_mode == "incremental":
+        segments = input_template.format_segments({"conversation": conversations})
+        return [segment_encoder.encode(segments)], translated_content
     input_message = input_template.format_example({"conversation": conversations})
-    message_ids = [template.encode_oneturn(tokenizer=tokenizer, messages=input_message)[0]]
-    sft_output = infer_model(message_ids, sft_lora_path)
-    dpo_output = infer_model(message_ids, dpo_lora_path)
+    return [template.encode_oneturn(tokenizer=tokenizer, messages=input_message)[0]], translated_content
+
+
+async def _reply_and_translate(message_ids, lora_request: LoRARequest, is_english: bool):
+    # each back-translation starts as soon as its own reply is done, alongside the other adapter's request
+    output = await infer_model(message_ids, lora_request)
+    if is_english:
+        return output, await translate(output, to_english=True)
+    return output, output
+
+
+async def get_model_response(conversations: List[Dict[str, str]]):
+    is_english = not re.search(r'[\u4e00-\u9fff]', conversations[-1]['content'])
+    arms = {arm: adapter_registry.resolve(arm) for arm in ("sft", "dpo")}  # fixed for the whole turn
+    adapters = {arm: adapter.name for arm, adapter in arms.items()}
+    message_ids, translated_content = await _prepare_prompt(conversations, is_english)
+    (sft_output, sft), (dpo_output, dpo) = await asyncio.gather(
+        _reply_and_translate(message_ids, arms["sft"].request, is_english),
+        _reply_and_translate(message_ids, arms["dpo"].request, is_english)
+    )
     if is_english:
-        sft = translate(sft_output, to_english=True)
-        dpo = translate(dpo_output, to_english=True)
         return {
             "sft": sft, "dpo": dpo, "is_english": is_english,
             "chinese_sft": sft_output, "chinese_dpo": dpo_output,
-            "translated_content": translated_content
+            "translated_content": translated_content, "adapters": adapters
         }
     else:
-        return {"sft": sft_output, "dpo": dpo_output, "is_english": is_english}
+        return {"sft": sft_output, "dpo": dpo_output, "is_english": is_english, "adapters": adapters}
+
+
+async def stream_reply(
+        message_ids, lora_request: LoRARequest, hide_reasoning: bool = True
+) -> AsyncGenerator[Tuple[str, str], None]:
+    """
+    Streams one adapter's reply as ("token", text) events. A ("reset", "") event tells the client to
+    discard what it was shown when an attempt ends without the reply marker and is resampled.
+    The final event is ("done", reply).
+    """
+    retry_stats["requests"] += 1
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            retry_stats["retries"] += 1
+            yield "reset", ""
+        parser = MarkerStreamParser(REPLY_MARKER, hide_reasoning=hide_reasoning, stop_strings=stop_strings)
+        async for delta in stream_generate(
+                message_ids[0], SamplingParams(seed=random.randint(0, 4096), **reply_kwargs), lora_request
+        ):
+            visible = parser.feed(delta).replace("\n", "")
+            if visible:
+                yield "token", visible
+        visible = parser.finish().replace("\n", "")
+        if visible:
+            yield "token", visible
+        if parser.reply is not None:
+            yield "done", parser.reply.replace("\n", "")
+            return
+        retry_stats["malformed_samples"] += 1
+
+    retry_stats["fallbacks"] += 1
+    logger.warning(f"No reply marker from {lora_request.lora_name} after {max_retries + 1} attempts, forcing the reply.")
+    yield "reset", ""
+    parser = MarkerStreamParser(REPLY_MARKER, stop_strings=stop_strings)
+    parser.feed(REPLY_MARKER)  # the prompt already ends in the marker
+    async for delta in stream_generate(
+            message_ids[0] + marker_ids, SamplingParams(seed=random.randint(0, 4096), **reply_kwargs), lora_request
+    ):
+        visible = parser.feed(delta).replace("\n", "")
+        if visible:
+            yield "token", visible
+    visible = parser.finish().replace("\n", "")
+    if visible:
+        yield "token", visible
+    yield "done", parser.reply.replace("\n", "")
+
+
+async def stream_translate(text, to_english=True) -> AsyncGenerator[Tuple[str, str], None]:
+    key = _translation_key(text, to_english)
+    if key in translation_cache:
+        translation_cache.move_to_end(key)
+        yield "token", translation_cache[key]
+        yield "done", translation_cache[key]
+        return
+
+    reply = ""
+    async for delta in stream_generate(
+            _translation_ids(text, to_english)[0], SamplingParams(seed=random.randint(0, 4096), **generation_kwargs)
+    ):
+        delta = delta.replace("\n", "")
+        reply += delta
+        yield "token", delta
+    _cache_translation(key, reply)
+    yield "done", reply
+
+
+async def stream_model_response(
+        conversations: List[Dict[str, str]], hide_reasoning: bool = True
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Streams both candidate replies as they are decoded. Yields {"event": "token" | "reset", "model", "text"}
+    events interleaved across the sft and dpo adapters, and finally {"event": "done", "response": ...}
+    holding the same dict as `get_model_response`. For English users the Chinese replies are kept back and
+    their translations are streamed instead.
+    """
+    is_english = not re.search(r'[\u4e00-\u9fff]', conversations[-1]['content'])
+    arms = {arm: adapter_registry.resolve(arm) for arm in ("sft", "dpo")}
+    message_ids, translated_content = await _prepare_prompt(conversations, is_english)
+    queue: asyncio.Queue = asyncio.Queue()
+    replies, chinese_replies = {}, {}
+
+    async def produce(name: str):
+        try:
+            async for event, text in stream_reply(message_ids, arms[name].request, hide_reasoning or is_english):
+                if event == "done":
+                    chinese_replies[name] = text
+                elif not is_english:
+                    await queue.put({"event": event, "model": name, "text": text})
+
+            if is_english:
+                async for event, text in stream_translate(chinese_replies[name], to_english=True):
+                    if event == "done":
+                        replies[name] = text
+                    else:
+                        await queue.put({"event": event, "model": name, "text": text})
+            else:
+                replies[name] = chinese_replies[name]
+        finally:
+            await queue.put(None)
+
+    producers = [
+        asyncio.create_task(produce("sft")),
+        asyncio.create_task(produce("dpo"))
+    ]
+    try:
+        finished = 0
+        while finished < len(producers):
+            event = await queue.get()
+            if event is None:
+                finished += 1
+            else:
+                yield event
+        await asyncio.gather(*producers)  # re-raises generation errors
+    finally:
+        for producer in producers:
+            producer.cancel()
+
+    response = {
+        "sft": replies["sft"], "dpo": replies["dpo"], "is_english": is_english,
+        "adapters": {arm: adapter.name for arm, adapter in arms.items()}
+    }
+    if is_english:
+        response.update({
+            "chinese_sft": chinese_replies["sft"], "chinese_dpo": chinese_replies["dpo"],
+            "translated_content": translated_content
+        })
+    yield {"event": "done", "response": response}
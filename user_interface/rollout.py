@@ -0,0 +1,9 @@
+# Entry point of the batched self-play rollout, kept apart so `python -m user_interface.interact` stays the chat.
+#
+#   python -m user_interface.rollout --output_path dialogues.jsonl --num_dialogues 1000
+
+from fire import Fire
+from user_interface.interact import rollout
+
+if __name__ == '__main__':
+    Fire(rollout)
@@ -0,0 +1,268 @@
+import os
+import copy
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from glob import glob
+from typing import Any, Dict, List, Tuple
+from fire import Fire
+
+
+class SessionStore:
+    r"""
+    Append-only storage for study sessions.
+
+    Every session is an event log `{root}/{username}_{start_time}.jsonl`. Handlers append one line per event
+    instead of rewriting the whole dialogue file, so the cost of an event does not grow with the session.
+    Each append is a single `write` on an `O_APPEND` descriptor, so concurrent requests of the same session
+    cannot overwrite each other. `load` replays the log into the dialogue JSON shape, and `export` writes
+    that shape to `{root}/{username}_{start_time}.json` once the session is over.
+    """
+
+    def __init__(self, root: str = "user_interface/dialogues") -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def log_path(self, session_id: str) -> str:
+        return os.path.join(self.root, f"{session_id}.jsonl")
+
+    def json_path(self, session_id: str) -> str:
+        return os.path.join(self.root, f"{session_id}.json")
+
+    def exists(self, session_id: str) -> bool:
+        return os.path.exists(self.log_path(session_id)) or os.path.exists(self.json_path(session_id))
+
+    def append(self, session_id: str, *events: Dict[str, Any]) -> None:
+        """
+        Appends events to the session log in one write.
+        """
+        self.append_lines(session_id, [encode_event(event) for event in events])
+
+    def append_lines(self, session_id: str, lines: List[str]) -> None:
+        """
+        Appends events already encoded by `encode_event` to the session log in one write.
+        """
+        if not os.path.exists(self.log_path(session_id)) and os.path.exists(self.json_path(session_id)):
+            # a session exported before the log existed: start the log from its JSON, or the next export drops it
+            with open(self.json_path(session_id), "r") as file:
+                lines = [encode_event({"type": "imported", "record": json.load(file)})] + lines
+        data = "".join(lines).encode("utf-8")
+        fd = os.open(self.log_path(session_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def load(self, session_id: str) -> Dict[str, Any]:
+        """
+        Rebuilds the session record from its event log, or reads a session exported before the log existed.
+        """
+        if not os.path.exists(self.log_path(session_id)):
+            if os.path.exists(self.json_path(session_id)):
+                with open(self.json_path(session_id), "r") as file:
+                    return json.load(file)
+            return new_record()
+
+        record = new_record()
+        with open(self.log_path(session_id), "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    apply_event(record, json.loads(line))
+        return record
+
+    def export(self, session_id: str) -> str:
+        """
+        Writes the replayed session in the dialogue JSON shape and returns its path.
+        """
+        record = self.load(session_id)
+        with open(self.json_path(session_id), "w") as file:
+            json.dump(record, file, indent=4)
+        return self.json_path(session_id)
+
+
+class SessionCache:
+    r"""
+    In-memory cache of session records in front of a `SessionStore`, with write-behind persistence.
+
+    Records are kept in an LRU bounded by `max_sessions` and dropped after `ttl` seconds without access
+    (the lifetime of the login cookie). Appended events are applied to the cached record and queued as
+    encoded lines, so the handlers may go on modifying the event dicts. `run` flushes the queue to the event
+    logs in batches every `flush_interval` seconds, writing from a worker thread, and `close` flushes, exports
+    and evicts a finished session. Events still queued when the process dies are lost, so keep
+    `flush_interval` short.
+    """
+
+    def __init__(
+            self, store: SessionStore, max_sessions: int = 1024, ttl: float = 3600, flush_interval: float = 5
+    ) -> None:
+        self.store = store
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._records: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self._pending: Dict[str, List[str]] = {}
+        self._flushing: Dict[str, List[str]] = {}  # sessions of the batch not written yet
+        self._write_lock = threading.Lock()  # held while a session's batch is written, and by cache misses
+        self._flush_lock = asyncio.Lock()  # one flush at a time, so batches reach the logs in order
+
+    def exists(self, session_id: str) -> bool:
+        return (
+            session_id in self._records or session_id in self._pending or session_id in self._flushing
+            or self.store.exists(session_id)
+        )
+
+    def load(self, session_id: str) -> Dict[str, Any]:
+        """
+        Returns the cached record, reading the log only on a miss. The record is shared, do not modify it.
+        """
+        if session_id in self._records:
+            record, _ = self._records.pop(session_id)
+        else:
+            with self._write_lock:  # the log holds either all or none of the events being flushed
+                record = self.store.load(session_id)
+                for line in self._flushing.get(session_id, []) + self._pending.get(session_id, []):
+                    apply_event(record, json.loads(line))
+
+        self._records[session_id] = (record, time.monotonic())
+        self._evict()
+        return record
+
+    def append(self, session_id: str, *events: Dict[str, Any]) -> None:
+        """
+        Applies events to the cached record (if any) and queues them for the next flush.
+        """
+        if session_id in self._records:
+            record, _ = self._records[session_id]
+            for event in events:
+                apply_event(record, event)
+            self._records[session_id] = (record, time.monotonic())
+            self._records.move_to_end(session_id)
+
+        # encoded now: the worker thread writing them must not read dicts the handlers may still modify
+        self._pending.setdefault(session_id, []).extend(encode_event(event) for event in events)
+
+    async def flush(self) -> None:
+        """
+        Writes all queued events, one append per session, in a worker thread.
+        """
+        async with self._flush_lock:
+            self._flushing, self._pending = self._pending, {}
+            try:
+                if self._flushing:
+                    await asyncio.to_thread(self._write, self._flushing)
+            finally:
+                for session_id, events in self._flushing.items():  # requeue what failed, ahead of newer events
+                    self._pending[session_id] = events + self._pending.get(session_id, [])
+                self._flushing = {}
+
+    def _write(self, batch: Dict[str, List[str]]) -> None:
+        for session_id in list(batch):
+            with self._write_lock:
+                self.store.append_lines(session_id, batch[session_id])
+                del batch[session_id]
+
+    async def close(self, session_id: str) -> str:
+        """
+        Flushes the queue, exports the session to its JSON file and evicts it.
+        """
+        await self.flush()
+        self._records.pop(session_id, None)
+        return await asyncio.to_thread(self.store.export, session_id)
+
+    async def run(self) -> None:
+        """
+        Flushes and expires sessions periodically, meant to run as a background task.
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self._expire()
+                await self.flush()
+            except Exception:
+                logging.exception("Failed to flush session events.")
+
+    def _expire(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        while self._records and next(iter(self._records.values()))[1] < deadline:
+            self._records.popitem(last=False)
+
+    def _evict(self) -> None:
+        # queued events stay in `_pending`, so evicted records can be rebuilt from the log plus the queue
+        while len(self._records) > self.max_sessions:
+            self._records.popitem(last=False)
+
+
+def encode_event(event: Dict[str, Any]) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+def new_record(**fields) -> Dict[str, Any]:
+    record = {"dialogue": [], "feedback": [], "ratings": []}
+    record.update(fields)
+    return record
+
+
+def apply_event(record: Dict[str, Any], event: Dict[str, Any]) -> None:
+    r"""
+    Applies one logged event to a session record, mirroring what the handlers used to write in place.
+    """
+    event_type = event["type"]
+    if event_type == "imported":  # the JSON of a session exported before the log existed
+        record.clear()
+        record.update(copy.deepcopy(event["record"]))
+    elif event_type == "session":  # (re)starting a session resets the record
+        fields = {key: value for key, value in event.items() if key != "type"}
+        record.clear()
+        record.update(fields)
+        record.update(dialogue=[], feedback=[], ratings=[])
+    elif event_type == "presurvey":
+        record["presurvey"] = event["presurvey"]
+    elif event_type == "user_turn":
+        record["dialogue"].append(event["turn"])
+    elif event_type == "assistant_turn":
+        if "translated_content" in event and record["dialogue"]:
+            record["dialogue"][-1]["translated_content"] = event["translated_content"]
+        record["dialogue"].append(event["turn"])
+    elif event_type == "selected":
+        if record["dialogue"]:
+            record["dialogue"][-1]["content"] = event["content"]
+        else:
+            record["dialogue"].append({"content": event["content"], "time": event["time"]})
+    elif event_type == "feedback":
+        record["feedback"].append(event["feedback"])
+    elif event_type == "rating":
+        record["ratings"].append(event["rating"])
+    elif event_type == "post_survey":
+        record["post-survey"] = event["post_survey"]
+    else:
+        raise ValueError(f"Unknown session event: {event_type}")
+
+
+def turn_events(user_turn: Dict[str, Any], responses: Dict[str, Any], current_time: str) -> List[Dict[str, Any]]:
+    r"""
+    Builds the events recording one `/chat` exchange from the user turn and the model responses.
+    """
+    assistant_turn = {"role": "assistant", "time": current_time, "sft": responses["sft"], "dpo": responses["dpo"]}
+    if "adapters" in responses:  # which adapter filled each arm, as arms can be reassigned mid-study
+        assistant_turn["adapters"] = responses["adapters"]
+    assistant_event = {"type": "assistant_turn", "turn": assistant_turn}
+    if responses.get("is_english", False):
+        assistant_event["translated_content"] = responses["translated_content"]
+        assistant_turn["chinese_sft"] = responses["chinese_sft"]
+        assistant_turn["chinese_dpo"] = responses["chinese_dpo"]
+    return [{"type": "user_turn", "turn": user_turn}, assistant_event]
+
+
+def main(root: str = "user_interface/dialogues") -> None:
+    """Exports every session log under `root` to the dialogue JSON shape."""
+    store = SessionStore(root)
+    for log_path in sorted(glob(os.path.join(root, "*.jsonl"))):
+        session_id = os.path.basename(log_path)[:-len(".jsonl")]
+        print(store.export(session_id))
+
+
+if __name__ == "__main__":
+    Fire(main)
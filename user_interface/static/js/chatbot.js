@@ -67,45 +67,78 @@ $(document).ready(function () {
         $("#user_input").val("");
         scrollToBottom();
 
-        $.post("/chat", {message: userMessage}, function (response) {
-            let responseId = response.response_id;
-            let replyOptions = response.reply_options; // Expecting two responses
-
-            if (userMode === "anonymous") {
-                pendingFeedback++;
-            }
+        if (userMode === "anonymous") {
+            pendingFeedback++;
+        }
 
-            $("#chat_message").append(`
-                <div class="bot-container" data-response-id="${responseId}">
-                    <div class="bot-info">
-                        <img src="/static/images/bear.jpg" class="avatar bot-avatar" alt="Bot Avatar">
-                        <span class="bot-name">同理心倾听者 Empathetic-Listener</span>
-                    </div>
-                    <p class="instruction">请选择一个更好的回答： / Please select one preferred response:</p>
-                    <div class="bot-response-container">
-                        <div class="message bot response-option" data-response="${replyOptions[0]}">${replyOptions[0]}</div>
-                        <div class="message bot response-option" data-response="${replyOptions[1]}">${replyOptions[1]}</div>
-                    </div>
+        // Render both candidate bubbles up front and fill them as tokens stream in.
+        $("#chat_message").append(`
+            <div class="bot-container streaming">
+                <div class="bot-info">
+                    <img src="/static/images/bear.jpg" class="avatar bot-avatar" alt="Bot Avatar">
+                    <span class="bot-name">同理心倾听者 Empathetic-Listener</span>
                 </div>
-            `);
-
-            // **确保两个气泡的宽度和高度一致**
-            setTimeout(() => {
-                let maxHeight = Math.max(
-                    $(".bot-container:last .response-option").eq(0).outerHeight(),
-                    $(".bot-container:last .response-option").eq(1).outerHeight()
-                );
+                <p class="instruction">请选择一个更好的回答： / Please select one preferred response:</p>
+                <div class="bot-response-container">
+                    <div class="message bot response-pending"></div>
+                    <div class="message bot response-pending"></div>
+                </div>
+            </div>
+        `);
+        let botContainer = $(".bot-container:last");
+        let bubbles = botContainer.find(".response-pending");
+        scrollToBottom();
 
-                $(".bot-container:last .response-option").css({
-                    "height": maxHeight + "px"
+        function handleEvent(event) {
+            if (event.event === "token") {
+                bubbles.eq(event.option).append(document.createTextNode(event.text));
+                scrollToBottom();
+            } else if (event.event === "reset") {
+                bubbles.eq(event.option).text("");
+            } else if (event.event === "done") {
+                let replyOptions = event.reply_options; // Expecting two responses
+                botContainer.removeClass("streaming").attr("data-response-id", event.response_id);
+                bubbles.each(function (i) {
+                    $(this).text(replyOptions[i]).attr("data-response", replyOptions[i])
+                        .removeClass("response-pending").addClass("response-option");
                 });
-            }, 100);
 
-            scrollToBottom();
-            waitingForBot = false;
-            updateInputState(waitingForBot, pendingFeedback);
-        }).fail(function () {
+                // **确保两个气泡的宽度和高度一致**
+                setTimeout(() => {
+                    let maxHeight = Math.max(bubbles.eq(0).outerHeight(), bubbles.eq(1).outerHeight());
+                    bubbles.css({"height": maxHeight + "px"});
+                }, 100);
+
+                scrollToBottom();
+                waitingForBot = false;
+                updateInputState(waitingForBot, pendingFeedback);
+            }
+        }
+
+        fetch("/chat_stream", {
+            method: "POST",
+            headers: {"Content-Type": "application/x-www-form-urlencoded"},
+            body: new URLSearchParams({message: userMessage, hide_reasoning: "true"}).toString()
+        }).then(async function (response) {
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            let reader = response.body.getReader();
+            let decoder = new TextDecoder();
+            let buffer = "";
+            while (true) {
+                let {value, done} = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, {stream: true});
+                let lines = buffer.split("\n");
+                buffer = lines.pop();
+                lines.filter(line => line.trim()).forEach(line => handleEvent(JSON.parse(line)));
+            }
+            if (botContainer.hasClass("streaming")) throw new Error("Stream ended early");
+        }).catch(function () {
             alert("错误：机器人未响应，请重试。");
+            botContainer.remove();
+            if (userMode === "anonymous") {
+                pendingFeedback--;
+            }
             waitingForBot = false;
             updateInputState(waitingForBot, pendingFeedback);
         });
@@ -2,6 +2,7 @@ import json
 import re
 import os
 import copy
+from concurrent.futures import ProcessPoolExecutor
 
 abs_path = os.path.abspath(__file__)
 abs_dir = '/'.join(abs_path.split('/')[:-1])
@@ -34,6 +35,35 @@ def is_json(myjson):
     return True
 
 
+# strict=False accepts raw newlines inside strings, which LLM outputs often contain
+_json_decoder = json.JSONDecoder(strict=False)
+
+
+def iter_jsons(text):
+    """
+    Scans a string once for JSON objects, including nested ones, and yields them with their offsets.
+
+    Every '{' is handed to the C decoder, which parses the brace-balanced object starting there in one pass
+    (braces inside strings included) and returns where it ends; the scan resumes after it. A '{' that does
+    not start a valid object, e.g. one in prose, is skipped and the scan goes on inside it.
+
+    Parameters:
+        text (str): The string to be scanned.
+
+    Yields:
+        Tuple[int, int, Dict]: The start and end offsets of each valid outermost JSON object and the object.
+    """
+    start = text.find('{')
+    while start >= 0:
+        try:
+            json_object, end = _json_decoder.raw_decode(text, start)
+        except ValueError:
+            start = text.find('{', start + 1)
+        else:
+            yield start, end, json_object
+            start = text.find('{', end)
+
+
 def is_json_inside(text):
     """
     Checks whether a given string contains valid JSON(s).
@@ -44,11 +74,8 @@ def is_json_inside(text):
     Returns:
         bool: True if the string contains valid JSON(s), False otherwise.
     """
-    text = re.sub(r"\s+", " ", text)
-    matches = re.findall(r"\{.*?\}", text)
-    for match in matches:
-        if is_json(match):
-            return True
+    for _ in iter_jsons(text):
+        return True
     return False
 
 
@@ -62,16 +89,25 @@ def extract_jsons(text):
     Returns:
         List[Dict]: A list of all extracted JSON objects.
     """
-    text = re.sub(r"\s+", " ", text)
-    matches = re.findall(r"\{.*?\}", text)
-    parsed_jsons = []
-    for match in matches:
-        try:
-            json_object = json.loads(match)
-            parsed_jsons.append(json_object)
-        except ValueError:
-            pass
-    return parsed_jsons
+    return [json_object for _, _, json_object in iter_jsons(text)]
+
+
+def extract_jsons_batch(texts, num_workers=None, chunksize=1024):
+    """
+    Extracts the JSON objects of many strings, in a process pool if `num_workers` is given.
+
+    Parameters:
+        texts (List[str]): The strings from which JSON objects are to be extracted.
+        num_workers (int): The number of worker processes; None extracts in this process.
+        chunksize (int): The number of strings sent to a worker at a time.
+
+    Returns:
+        List[List[Dict]]: The extracted JSON objects of each string, in order.
+    """
+    if not num_workers or num_workers <= 1 or len(texts) <= chunksize:
+        return [extract_jsons(text) for text in texts]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(extract_jsons, texts, chunksize=chunksize))
 
 
 def extract_code(text):
@@ -223,3 +259,51 @@ class Configurable:
 
     def save_config(self, path: str):
         self.to_config().save(path)
+
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """
+    Streams the items of a file holding one JSON array, reading `chunk_size` characters at a time instead of
+    loading the whole file.
+
+    Parameters:
+        path (str): The JSON file, e.g. a list of dialogues.
+        chunk_size (int): The number of characters read at a time.
+
+    Yields:
+        Any: The items of the array, in order.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as file:
+        buffer, pos, opened, eof = '', 0, False, False
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f'{path} ends before its JSON array is closed.')
+                chunk = file.read(chunk_size)
+                buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                continue
+            if not opened:
+                if buffer[pos] != '[':
+                    raise ValueError(f'{path} does not hold a JSON array.')
+                opened, pos = True, pos + 1
+            elif buffer[pos] == ']':
+                return
+            elif buffer[pos] == ',':
+                pos += 1
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                    end = None
+                if end is None or (end == len(buffer) and not eof):
+                    # the item runs past the buffer (or a number may go on): read more and decode it again
+                    chunk = file.read(chunk_size)
+                    buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                    continue
+                yield item
+                pos = end
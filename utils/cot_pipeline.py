@@ -0,0 +1,339 @@
+# Chain-of-thought annotation of PsyDTCorpus with the `generate_cot` template.
+#
+# Every listener turn of the training dialogues becomes one request: the history, the listener reply and (if
+# annotated) the client state go into `COTTemplate.format_example`, and the completion is the listener's
+# chain of thought. Requests fan out over all endpoints of a backend, with a concurrency limit per endpoint and
+# backoff on rate limits. Results are appended to a JSONL file as they arrive; the file doubles as the
+# checkpoint, so a restarted job skips the examples it already holds.
+#
+#   python -m utils.cot_pipeline --output_path cot.jsonl                      # Azure endpoints in config.json
+#   python -m utils.cot_pipeline --output_path cot.jsonl --backend vllm --base_urls http://localhost:8000/v1
+#   python -m utils.cot_pipeline --output_path cot.jsonl --backend mock --limit 100
+
+import os
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+import openai
+from fire import Fire
+from utils.config_utils import configs, iter_json_array, MODEL_PATH, TRAIN_DATA_PATH, USER_STATE_PATH, END_POINTS
+from utils.template_utils import get_template
+
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per request otherwise
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError)
+
+
+def load_user_states(user_state_path: str = USER_STATE_PATH) -> Dict[Tuple[str, int], str]:
+    r"""
+    Reads the client-state annotations, one JSON object per line with the dialogue `id`, the index `turn` of the
+    listener message in `messages` and the `user_state` text.
+    """
+    user_states = {}
+    if not os.path.exists(user_state_path):
+        logging.warning(f"No user states at {user_state_path}, the chains of thought are generated without them.")
+        return user_states
+    with open(user_state_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                user_states[(str(record["id"]), int(record["turn"]))] = record["user_state"]
+    return user_states
+
+
+def iter_examples(
+        train_data_path: str = TRAIN_DATA_PATH, user_state_path: str = USER_STATE_PATH, skip: Set[str] = frozenset()
+) -> Iterator[Dict[str, Any]]:
+    r"""
+    Yields one example per listener turn of the PsyDTCorpus dialogues (`{"id", "messages": [...]}`), skipping the
+    example ids in `skip`.
+    """
+    user_states = load_user_states(user_state_path)
+    for dialogue_idx, dialogue in enumerate(iter_json_array(train_data_path)):  # parsed as it is read
+        dialogue_id = str(dialogue.get("id", dialogue_idx))
+        messages = dialogue["messages"]
+        for turn, message in enumerate(messages):
+            example_id = f"{dialogue_id}-{turn}"
+            if message["role"] != "assistant" or example_id in skip:
+                continue
+            yield {
+                "id": example_id,
+                "conversation": [msg for msg in messages[:turn] if msg["role"] in ("user", "assistant")],
+                "response": message["content"],
+                "user_state": user_states.get((dialogue_id, turn)),
+            }
+
+
+@dataclass
+class Endpoint:
+    r"""
+    One OpenAI-compatible endpoint with its own concurrency limit. A rate-limited request pauses the whole
+    endpoint until `cooldown_until`, so its other workers do not keep hitting the limit.
+    """
+    name: str
+    client: Any
+    model: str
+    concurrency: int = 8
+    cooldown_until: float = 0.0
+    stats: Dict[str, int] = field(default_factory=lambda: {"done": 0, "retries": 0, "failed": 0})
+
+    async def wait_cooldown(self) -> None:
+        delay = self.cooldown_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def azure_endpoints(concurrency: int, model: str = MODEL_PATH["gpt-4o"]) -> List[Endpoint]:
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+
+    token_provider = get_bearer_token_provider(
+        DefaultAzureCredential(), configs["azure_config"]["token_provider_link"]
+    )
+    return [
+        Endpoint(
+            name=end_point,
+            client=openai.AsyncAzureOpenAI(
+                azure_endpoint=end_point,
+                api_version=configs["azure_config"]["api_version"],
+                azure_ad_token_provider=token_provider,
+                max_retries=0,  # retried by the pipeline, which also pauses the endpoint
+            ),
+            model=model,
+            concurrency=concurrency,
+        )
+        for end_point in END_POINTS
+    ]
+
+
+def openai_endpoints(base_urls: Sequence[str], model: str, concurrency: int) -> List[Endpoint]:
+    # vLLM's OpenAI-compatible server, the mock server, or any other compatible API
+    return [
+        Endpoint(
+            name=base_url,
+            client=openai.AsyncOpenAI(base_url=base_url, api_key=os.environ.get("OPENAI_API_KEY", "EMPTY"),
+                                      max_retries=0),
+            model=model,
+            concurrency=concurrency,
+        )
+        for base_url in base_urls
+    ]
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class COTPipeline:
+    def __init__(
+            self,
+            endpoints: List[Endpoint],
+            output_path: str,
+            template_name: str = "generate_cot",
+            max_attempts: int = 6,
+            max_backoff: float = 60.0,
+            generation_kwargs: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.endpoints = endpoints
+        self.output_path = output_path
+        self.template = get_template(template_name)
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.generation_kwargs = generation_kwargs or {"temperature": 0.7, "max_tokens": 1024}
+
+    def completed_ids(self) -> Set[str]:
+        r"""
+        Returns the example ids already in the output file, after dropping a last line cut off by a crash.
+        """
+        if not os.path.exists(self.output_path):
+            return set()
+        with open(self.output_path, "rb+") as file:
+            data = file.read()
+            if data and not data.endswith(b"\n"):
+                file.truncate(data.rfind(b"\n") + 1)
+                data = data[:data.rfind(b"\n") + 1]
+        return {json.loads(line)["id"] for line in data.decode("utf-8").splitlines() if line.strip()}
+
+    def build_messages(self, example: Dict[str, Any]) -> List[Dict[str, str]]:
+        messages = self.template.format_example(example, use_gpt=True)[:-1]  # drop the empty assistant turn
+        return [{"role": "system", "content": self.template.system}] + messages
+
+    async def request(self, endpoint: Endpoint, example: Dict[str, Any]) -> Optional[str]:
+        messages = self.build_messages(example)
+        for attempt in range(self.max_attempts):
+            await endpoint.wait_cooldown()
+            try:
+                completion = await endpoint.client.chat.completions.create(
+                    model=endpoint.model, messages=messages, **self.generation_kwargs
+                )
+                return completion.choices[0].message.content
+            except RETRYABLE_ERRORS as error:
+                endpoint.stats["retries"] += 1
+                delay = _retry_after(error) or min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.5)
+                if isinstance(error, openai.RateLimitError):
+                    endpoint.cooldown_until = max(endpoint.cooldown_until, time.monotonic() + delay)
+                logging.info(f"{endpoint.name}: {type(error).__name__}, retrying {example['id']} in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+            except openai.APIStatusError as error:  # e.g. a prompt rejected by the content filter
+                logging.warning(f"{endpoint.name}: {example['id']} failed with {error.status_code}.")
+                break
+        endpoint.stats["failed"] += 1
+        return None
+
+    async def run(self, examples: Iterator[Dict[str, Any]]) -> Dict[str, Dict[str, int]]:
+        workers = sum(endpoint.concurrency for endpoint in self.endpoints)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * workers)  # bounded, so examples are read as needed
+
+        with open(self.output_path, "a", encoding="utf-8") as output:
+            async def worker(endpoint: Endpoint) -> None:
+                while True:
+                    example = await queue.get()
+                    if example is None:
+                        return
+                    try:
+                        cot = await self.request(endpoint, example)
+                        if cot is not None:
+                            output.write(json.dumps(dict(example, cot=cot, endpoint=endpoint.name),
+                                                    ensure_ascii=False) + "\n")
+                            output.flush()
+                            endpoint.stats["done"] += 1
+                    except Exception as error:  # e.g. a response without choices, the worker goes on
+                        endpoint.stats["failed"] += 1
+                        logging.warning(f"{endpoint.name}: {example['id']} failed with {type(error).__name__}: "
+                                        f"{error}")
+
+            async def produce() -> None:
+                for example in examples:
+                    await queue.put(example)
+                for _ in tasks:
+                    await queue.put(None)
+
+            tasks = [
+                asyncio.create_task(worker(endpoint))
+                for endpoint in self.endpoints for _ in range(endpoint.concurrency)
+            ]
+            producer = asyncio.create_task(produce())
+            # a failed producer, or a worker that died, stops the run instead of leaving the other side blocked
+            done, pending = await asyncio.wait([producer, *tasks], return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        return {endpoint.name: endpoint.stats for endpoint in self.endpoints}
+
+
+def mock_app(latency: float = 0.05, rate_limit_prob: float = 0.0):
+    r"""
+    A local stand-in for an OpenAI-compatible chat endpoint, returning a canned chain of thought after `latency`
+    seconds and a 429 with `Retry-After` with probability `rate_limit_prob`.
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if random.random() < rate_limit_prob:
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached.", "type": "rate_limit"}},
+                status_code=429, headers={"Retry-After": "0.1"}
+            )
+        await asyncio.sleep(latency)
+        content = "我对来访者有如下判断：来访者感到焦虑。在接下来的回复中，我将重点关注于来访者的感受。相对应，我将采取安慰的策略。"
+        return {
+            "id": f"chatcmpl-{random.getrandbits(64):x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    return app
+
+
+def start_mock_server(latency: float = 0.05, rate_limit_prob: float = 0.0) -> str:
+    r"""
+    Serves `mock_app` from a daemon thread on a free local port and returns its base URL.
+    """
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        mock_app(latency, rate_limit_prob), host="127.0.0.1", port=port, log_level="warning"
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+def main(
+        output_path: str,
+        backend: str = "azure",
+        base_urls: Optional[Sequence[str]] = None,
+        model: Optional[str] = None,
+        concurrency: int = 8,
+        train_data_path: str = TRAIN_DATA_PATH,
+        user_state_path: str = USER_STATE_PATH,
+        limit: Optional[int] = None,
+        max_attempts: int = 6,
+        mock_rate_limit_prob: float = 0.0
+) -> None:
+    r"""
+    Annotates the training dialogues with chains of thought.
+
+    Args:
+        backend: "azure" (the `end_points` of utils/config.json), "vllm" (OpenAI-compatible servers at `base_urls`)
+            or "mock" (a local mock server).
+        concurrency: in-flight requests per endpoint.
+        limit: number of new examples to annotate in this run.
+    """
+    if backend == "azure":
+        endpoints = azure_endpoints(concurrency, model or MODEL_PATH["gpt-4o"])
+    elif backend == "vllm":
+        if not base_urls:
+            raise ValueError("The vllm backend needs --base_urls.")
+        base_urls = [base_urls] if isinstance(base_urls, str) else base_urls
+        endpoints = openai_endpoints(base_urls, model or MODEL_PATH["qwen-2.5-7b"], concurrency)
+    elif backend == "mock":
+        endpoints = openai_endpoints([start_mock_server(rate_limit_prob=mock_rate_limit_prob)], "mock", concurrency)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    pipeline = COTPipeline(endpoints, output_path, max_attempts=max_attempts)
+    done = pipeline.completed_ids()
+    logging.info(f"Resuming with {len(done)} examples already annotated.")
+    examples = iter_examples(train_data_path, user_state_path, skip=done)
+    if limit is not None:
+        examples = (example for _, example in zip(range(limit), examples))
+
+    start = time.perf_counter()
+    stats = asyncio.run(pipeline.run(examples))
+    elapsed = time.perf_counter() - start
+    for name, endpoint_stats in stats.items():
+        logging.info(f"{name}: {endpoint_stats}")
+    total = sum(endpoint_stats["done"] for endpoint_stats in stats.values())
+    logging.info(f"{total} examples in {elapsed:.1f}s ({total / max(elapsed, 1e-6):.1f}/s).")
+
+
+if __name__ == "__main__":
+    Fire(main)
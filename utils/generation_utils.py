@@ -0,0 +1,216 @@
+# Helpers for post-processing the outputs of the empathetic LLM and the user simulator.
+# Both models write their reasoning first and then the turn after a marker such as `【倾听者回复】：`.
+
+from typing import List, Optional, Sequence, Tuple
+import torch
+from transformers import DynamicCache, StoppingCriteria, StoppingCriteriaList
+from utils.config_utils import ROLE_MAP
+
+REPLY_MARKER = '【倾听者回复】：'
+USER_MARKER = '【来访者对话】：'
+
+
+def turn_stop_strings(role: str = 'assistant') -> List[str]:
+    r"""
+    Returns the strings that open the other party's turn, as in the dialogue history. A turn of `role` ends
+    before them, so they are safe as stop strings even while the reasoning is decoded.
+    """
+    other = ROLE_MAP['user' if role == 'assistant' else 'assistant']
+    return [f'\n{other}:', f'\n{other}：', f'\n\t{other}:']
+
+
+def cut_at_stop(text: str, stop_strings: Sequence[str] = ()) -> str:
+    """Drops everything from the first stop string on."""
+    end = len(text)
+    for stop in stop_strings:
+        index = text.find(stop)
+        if 0 <= index < end:
+            end = index
+    return text[:end]
+
+
+def split_turn(text: str, marker: str = REPLY_MARKER, stop_strings: Sequence[str] = ()) -> Tuple[str, str]:
+    r"""
+    Splits a finished generation into the reasoning and the turn after the last `marker`, cut at the first stop
+    string. Without the marker, the whole text is the turn.
+    """
+    reasoning, _, turn = text.rpartition(marker)
+    return reasoning, cut_at_stop(turn, stop_strings)
+
+
+class MarkerStreamParser:
+    r"""
+    Incrementally splits a streamed generation into the reasoning before a marker and the turn after it.
+
+    `feed` takes the newly decoded text and returns the part that should be shown now. With
+    `hide_reasoning`, nothing is shown until the marker has been decoded. After the marker, the turn ends at
+    the first of `stop_strings` (`stopped` is then set and later text is ignored); a tail that may be the
+    start of a stop string is held back until it is resolved, or until `finish` is called at the end of the
+    stream. Only the new text is searched on every call.
+    """
+
+    def __init__(
+            self, marker: str = REPLY_MARKER, hide_reasoning: bool = True, stop_strings: Sequence[str] = ()
+    ) -> None:
+        self.marker = marker
+        self.hide_reasoning = hide_reasoning
+        self.stop_strings = list(stop_strings)
+        self.text = ''
+        self.marker_found = False
+        self.stopped = False
+        self._reply_start = 0
+        self._emitted = 0
+
+    def feed(self, delta: str) -> str:
+        if self.stopped:
+            return ''
+        searched = len(self.text)
+        self.text += delta
+        if not self.marker_found:
+            index = self.text.find(self.marker, max(searched - len(self.marker) + 1, 0))
+            if index < 0:
+                if self.hide_reasoning:
+                    return ''
+                return self._emit(len(self.text))
+            self.marker_found = True
+            self._reply_start = searched = index + len(self.marker)
+            if self.hide_reasoning:
+                self._emitted = self._reply_start
+
+        end = len(self.text)
+        for stop in self.stop_strings:
+            index = self.text.find(stop, max(searched - len(stop) + 1, self._reply_start))
+            if 0 <= index < end:
+                end = index
+        if end < len(self.text):
+            self.stopped = True
+            self.text = self.text[:end]
+            return self._emit(end)
+
+        for stop in self.stop_strings:
+            for length in range(min(len(stop) - 1, end - self._reply_start), 0, -1):
+                if self.text.endswith(stop[:length]):
+                    end = min(end, len(self.text) - length)
+                    break
+        return self._emit(end)
+
+    def finish(self) -> str:
+        """Returns the text still held back once the stream has ended."""
+        return self._emit(len(self.text))
+
+    def _emit(self, end: int) -> str:
+        visible = self.text[self._emitted:end]
+        self._emitted = max(self._emitted, end)
+        return visible
+
+    @property
+    def reply(self) -> Optional[str]:
+        """The text after the last marker, or None if the marker was never decoded."""
+        if not self.marker_found:
+            return None
+        return self.text.split(self.marker)[-1]
+
+
+class IncrementalDetokenizer:
+    r"""
+    Turns token ids into text deltas one token at a time, holding back incomplete multi-byte characters.
+    Only the tokens since the last emitted character are decoded on every call.
+    """
+
+    def __init__(self, tokenizer) -> None:
+        self.tokenizer = tokenizer
+        self.tokens: List[int] = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def feed(self, token_id: int) -> str:
+        self.tokens.append(token_id)
+        prefix_text = self.tokenizer.decode(
+            self.tokens[self._prefix_offset:self._read_offset], skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(self.tokens[self._prefix_offset:], skip_special_tokens=True)
+        if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+            return ''
+        self._prefix_offset, self._read_offset = self._read_offset, len(self.tokens)
+        return new_text[len(prefix_text):]
+
+
+class MarkerStoppingCriteria(StoppingCriteria):
+    r"""
+    Stops each sequence of an HF `generate` call once its turn after `marker` reaches one of `stop_strings`,
+    parsing the new token of every row incrementally. Create one per `generate` call.
+    """
+
+    def __init__(self, tokenizer, marker: str = REPLY_MARKER, stop_strings: Sequence[str] = ()) -> None:
+        self.tokenizer = tokenizer
+        self.marker = marker
+        self.stop_strings = list(stop_strings)
+        self.parsers: Optional[List[MarkerStreamParser]] = None
+        self.detokenizers: Optional[List[IncrementalDetokenizer]] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.parsers is None:
+            self.parsers = [MarkerStreamParser(self.marker, stop_strings=self.stop_strings) for _ in input_ids]
+            self.detokenizers = [IncrementalDetokenizer(self.tokenizer) for _ in input_ids]
+        for parser, detokenizer, token_id in zip(self.parsers, self.detokenizers, input_ids[:, -1].tolist()):
+            if not parser.stopped:
+                parser.feed(detokenizer.feed(token_id))
+        return torch.tensor([parser.stopped for parser in self.parsers], device=input_ids.device)
+
+
+def marker_stopping_criteria(
+        tokenizer, marker: str = REPLY_MARKER, stop_strings: Optional[Sequence[str]] = None
+) -> StoppingCriteriaList:
+    r"""
+    Builds the `stopping_criteria` of one HF `generate` call for a turn written after `marker`.
+    """
+    if stop_strings is None:
+        stop_strings = turn_stop_strings('user' if marker == USER_MARKER else 'assistant')
+    return StoppingCriteriaList([MarkerStoppingCriteria(tokenizer, marker, stop_strings)])
+
+
+class KVCacheSession:
+    r"""
+    Keeps the key/value cache of one HF dialogue between turns, so each turn only prefills the new tokens.
+
+    `generate` compares the new prompt with the tokens already in the cache, crops the cache to their common
+    prefix and feeds only the rest. Prompts built with `encode_segments` share their whole history with the
+    previous turn, so a turn costs its new text plus the template tail instead of the full history. When the
+    history window slides, the prefix ends at the first dropped turn and the rest is prefilled again.
+    """
+
+    def __init__(self, model, tokenizer) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.cache: Optional[DynamicCache] = None
+        self.cached_ids: List[int] = []
+
+    def reset(self) -> None:
+        self.cache = None
+        self.cached_ids = []
+
+    @torch.inference_mode()
+    def generate(self, input_ids: List[int], **generation_kwargs) -> str:
+        prefix = 0
+        for cached, new in zip(self.cached_ids, input_ids):
+            if cached != new:
+                break
+            prefix += 1
+        prefix = min(prefix, len(input_ids) - 1)  # the last prompt token is always fed to get the next logits
+
+        if self.cache is None or prefix == 0:
+            self.cache = DynamicCache()
+        else:
+            self.cache.crop(prefix)
+
+        inputs = torch.tensor([input_ids], device=self.model.device)
+        output_ids = self.model.generate(
+            input_ids=inputs,
+            attention_mask=torch.ones_like(inputs),
+            past_key_values=self.cache,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **generation_kwargs
+        )[0]
+        # the last sampled token is never fed back, so the cache ends one token short of the output
+        self.cached_ids = output_ids[:self.cache.get_seq_length()].tolist()
+        return self.tokenizer.decode(output_ids[len(input_ids):], skip_special_tokens=True).strip()
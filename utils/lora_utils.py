@@ -1,6 +1,23 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from typing import Dict, List, Sequence
+import torch
 from fire import Fire
+from huggingface_hub import split_torch_state_dict_into_shards
+from peft import PeftModel
+from peft.tuners.lora import LoraLayer
+from peft.utils import ModulesToSaveWrapper
+from safetensors.torch import save_file
+from llamafactory.data import get_template_and_fix_tokenizer
+from llamafactory.hparams import get_infer_args
+from llamafactory.model import load_model, load_tokenizer
 from llamafactory.train.tuner import export_model
 
+logging.getLogger().setLevel(logging.INFO)
+
 
 def main(
         model_name_or_path: str = '/home/v-jiaswang/models/Qwen2.5-7B-Instruct',
@@ -27,5 +44,159 @@ def main(
     export_model(args)
 
 
+class ShardWriter:
+    r"""
+    Writes safetensors shards from background threads. `write` copies the tensors of a shard to the CPU and
+    returns as soon as the copy is queued, so the caller can go on (e.g. restore the weights and merge the next
+    adapter) while earlier shards are still written. At most `max_pending` shards are held in memory.
+    """
+
+    def __init__(self, num_threads: int = 4, max_pending: int = 8) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.pending = BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def write(self, tensors: Dict[str, torch.Tensor], path: str) -> None:
+        self.pending.acquire()
+        tensors = {name: tensor.detach().to("cpu", copy=True).contiguous() for name, tensor in tensors.items()}
+        future = self.executor.submit(save_file, tensors, path, metadata={"format": "pt"})
+        future.add_done_callback(lambda _: self.pending.release())
+        self.futures.append(future)
+
+    def wait(self) -> None:
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()  # re-raises write errors
+
+    def close(self) -> None:
+        self.wait()
+        self.executor.shutdown()
+
+
+def save_sharded(model, export_dir: str, export_size: int, writer: ShardWriter) -> None:
+    r"""
+    Saves the weights like `save_pretrained(max_shard_size=f"{export_size}GB", safe_serialization=True)`, with
+    the shards written by `writer`. Tied weights are stored once, as `save_pretrained` does.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    full_state_dict = model.state_dict()
+    if any(tensor.device.type == "meta" for tensor in full_state_dict.values()):
+        # weights offloaded by a `device_map` are meta tensors here, gather the real ones on the CPU
+        from accelerate.utils.modeling import get_state_dict_offloaded_model
+
+        full_state_dict = get_state_dict_offloaded_model(model)
+
+    state_dict, storages = {}, set()
+    for name, tensor in full_state_dict.items():
+        storage = (tensor.device, tensor.untyped_storage().data_ptr())
+        if tensor.device.type == "meta" or storage[1] == 0:  # no storage to share, every such tensor is its own
+            state_dict[name] = tensor
+        elif storage not in storages:
+            storages.add(storage)
+            state_dict[name] = tensor
+
+    split = split_torch_state_dict_into_shards(state_dict, max_shard_size=f"{export_size}GB")
+    for filename, names in split.filename_to_tensors.items():
+        writer.write({name: state_dict[name] for name in names}, os.path.join(export_dir, filename))
+    if split.is_sharded:
+        index = {"metadata": split.metadata, "weight_map": split.tensor_to_filename}
+        with open(os.path.join(export_dir, "model.safetensors.index.json"), "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+    model.config.save_pretrained(export_dir)
+    if model.can_generate() and model.generation_config is not None:
+        model.generation_config.save_pretrained(export_dir)
+
+
+def merge_and_restore(model, adapter_path: str, export_dir: str, export_size: int, writer: ShardWriter):
+    r"""
+    Merges one adapter into `model`, saves the merged weights and puts the base weights back in place, so the
+    next adapter starts again from the base model. Returns the (restored) base model.
+    """
+    peft_model = PeftModel.from_pretrained(model, adapter_path)
+    # snapshot what merging overwrites: the weights under the LoRA layers and the modules saved in full
+    snapshot = {
+        name: module.get_base_layer().weight.detach().to("cpu", copy=True)
+        for name, module in peft_model.base_model.model.named_modules() if isinstance(module, LoraLayer)
+    }
+    originals = {
+        name: module.original_module
+        for name, module in peft_model.base_model.model.named_modules() if isinstance(module, ModulesToSaveWrapper)
+    }
+
+    merged = peft_model.merge_and_unload()
+    save_sharded(merged, export_dir, export_size, writer)  # returns once the shards are copied to the CPU
+
+    with torch.no_grad():
+        for name, weight in snapshot.items():
+            merged.get_submodule(name).weight.copy_(weight)
+    for name, module in originals.items():
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(merged.get_submodule(parent_name) if parent_name else merged, child_name, module)
+    return merged
+
+
+def batch_export(
+        adapters: Sequence[str],
+        export_dir: str,
+        model_name_or_path: str = '/home/v-jiaswang/models/Qwen2.5-7B-Instruct',
+        template: str = 'qwen2.5',
+        trust_remote_code: bool = True,
+        export_size: int = 5,
+        export_device: str = "auto",
+        infer_dtype: str = "auto",
+        num_threads: int = 4
+):
+    r"""
+    Merges every adapter in `adapters` into the base model and saves each to `{export_dir}/{adapter name}`.
+
+    The base model is loaded once. After each export the overwritten weights are restored from a CPU snapshot
+    instead of reloading the model, and the safetensors shards are written by `num_threads` threads while the
+    next adapter is merged.
+    """
+    if isinstance(adapters, str):
+        adapters = [adapter.strip() for adapter in adapters.split(",")]
+    model_args, data_args, finetuning_args, _ = get_infer_args({
+        'model_name_or_path': model_name_or_path,
+        'template': template,
+        'finetuning_type': 'lora',
+        'trust_remote_code': trust_remote_code,
+        'export_dir': export_dir,
+        'export_size': export_size,
+        'export_device': export_device,
+        'infer_dtype': infer_dtype,
+    })
+    tokenizer_module = load_tokenizer(model_args)
+    tokenizer = tokenizer_module["tokenizer"]
+    get_template_and_fix_tokenizer(tokenizer, data_args)
+    model = load_model(tokenizer, model_args, finetuning_args)  # the base model, without adapters
+
+    if infer_dtype == "auto":
+        output_dtype = getattr(model.config, "torch_dtype", torch.float16)
+    else:
+        output_dtype = getattr(torch, infer_dtype)
+    setattr(model.config, "torch_dtype", output_dtype)
+    model = model.to(output_dtype)
+
+    tokenizer.padding_side = "left"  # as in `export_model`
+    tokenizer.init_kwargs["padding_side"] = "left"
+
+    writer = ShardWriter(num_threads=num_threads)
+    exported: List[str] = []
+    try:
+        for adapter_path in adapters:
+            adapter_dir = os.path.join(export_dir, os.path.basename(os.path.normpath(adapter_path)))
+            logging.info(f"Exporting {adapter_path} to {adapter_dir}.")
+            model = merge_and_restore(model, adapter_path, adapter_dir, export_size, writer)
+            tokenizer.save_pretrained(adapter_dir)
+            if tokenizer_module["processor"] is not None:
+                tokenizer_module["processor"].save_pretrained(adapter_dir)
+            exported.append(adapter_dir)
+    finally:
+        writer.close()
+    logging.info(f"Exported {len(exported)} models.")
+    return exported
+
+
 if __name__ == "__main__":
-    Fire(main)
+    Fire({'main': main, 'batch_export': batch_export})
@@ -1,7 +1,8 @@
 import time
 import hashlib
-from typing import List, Union
-from dataclasses import dataclass
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from dataclasses import dataclass, field
 from uuid import uuid1
 
 
@@ -19,22 +20,27 @@ def _hash(input: str):
     return hex_dig
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     content: str
     agent_name: str = ''
     turn: int = -1
-    timestamp: int = time.time_ns()
+    timestamp: int = field(default_factory=time.time_ns)
     visible_to: Union[str, List[str]] = "all"
     msg_type: str = "text"
     logged: bool = False  # Whether the message is logged in the database
+    _hash_cache: Optional[Tuple[tuple, str]] = field(default=None, init=False, repr=False, compare=False)
 
     @property
     def msg_hash(self):
-        # Generate a unique message id given the content, timestamp and role
-        return _hash(
-            f"agent: {self.agent_name}\ncontent: {self.content}\ntimestamp: {str(self.timestamp)}\nturn: {self.turn}\nmsg_type: {self.msg_type}"
-        )
+        # Generate a unique message id given the content, timestamp and role.
+        # The digest is cached together with the fields it covers, so it is recomputed only after they change.
+        key = (self.agent_name, self.content, self.timestamp, self.turn, self.msg_type)
+        if self._hash_cache is None or self._hash_cache[0] != key:
+            self._hash_cache = (key, _hash(
+                f"agent: {self.agent_name}\ncontent: {self.content}\ntimestamp: {str(self.timestamp)}\nturn: {self.turn}\nmsg_type: {self.msg_type}"
+            ))
+        return self._hash_cache[1]
 
     def __str__(self):
         """Print all the messages in the pool."""
@@ -49,17 +55,38 @@ class MessagePool:
     The pool is essentially a list of messages, and it allows a unified treatment of the visibility of the messages.
     It supports two configurations for step definition: multiple players can act in the same turn (like in rock-paper-scissors).
     Agents can only see the messages that 1) were sent before the current turn, and 2) are visible to the current role.
+
+    Every agent has an incrementally maintained view of the messages visible to it, with their turns, so a
+    visibility query is a binary search instead of a scan of the whole pool. This relies on messages being appended
+    in turn order; if one is not, queries fall back to scanning. `log_hook` receives the messages appended since the
+    last `flush_log`, so they can be persisted append-only.
     """
 
-    def __init__(self):
+    def __init__(self, log_hook: Optional[Callable[[List[Message]], None]] = None):
         """Initialize the MessagePool with a unique conversation ID."""
         self.conversation_id = str(uuid1())
+        self.log_hook = log_hook
         self._messages: List[Message] = []
         self._last_message_idx = 0
+        self._turns: List[int] = []
+        self._ordered = True
+        self._public: List[int] = []
+        self._private: Dict[str, List[int]] = {}
+        self._views: Dict[str, Tuple[List[Message], List[int]]] = {}
 
     def reset(self):
         """Clear the message pool."""
         self._messages = []
+        self._last_message_idx = 0
+        self._turns = []
+        self._ordered = True
+        self._public = []
+        self._private = {}
+        self._views = {}
+
+    @staticmethod
+    def _recipients(message: Message) -> List[str]:
+        return [message.visible_to] if isinstance(message.visible_to, str) else message.visible_to
 
     def append_message(self, message: Message):
         """
@@ -68,7 +95,47 @@ class MessagePool:
         Parameters:
             message (Message): The message to be added to the pool.
         """
+        idx = len(self._messages)
+        if self._turns and message.turn < self._turns[-1]:
+            self._ordered = False
         self._messages.append(message)
+        self._turns.append(message.turn)
+
+        if message.visible_to == "all":
+            self._public.append(idx)
+            targets = self._views.values()
+        else:
+            recipients = self._recipients(message)
+            for agent_name in recipients:
+                self._private.setdefault(agent_name, []).append(idx)
+            targets = [self._views[agent_name] for agent_name in recipients if agent_name in self._views]
+        for view, turns in targets:
+            view.append(message)
+            turns.append(message.turn)
+
+    def _view(self, agent_name) -> Tuple[List[Message], List[int]]:
+        if agent_name not in self._views:
+            # built once per agent by merging the public and private indexes, then kept up to date on append
+            indices = sorted(self._public + self._private.get(agent_name, []))
+            self._views[agent_name] = (
+                [self._messages[idx] for idx in indices], [self._turns[idx] for idx in indices]
+            )
+        return self._views[agent_name]
+
+    def flush_log(self) -> List[Message]:
+        """
+        Pass the messages appended since the last flush to `log_hook` and mark them as logged.
+
+        Returns:
+            List[Message]: The newly logged messages.
+        """
+        messages = self._messages[self._last_message_idx:]
+        if messages and self.log_hook is not None:
+            self.log_hook(messages)
+            for message in messages:
+                message.logged = True
+        self._last_message_idx = len(self._messages)
+        return messages
 
     def __str__(self):
         """Print all the messages in the pool."""
@@ -112,6 +179,20 @@ class MessagePool:
         """
         return self._messages
 
+    def get_turn_messages(self, turn: int) -> List[Message]:
+        """
+        Get all the messages sent in a given turn.
+
+        Parameters:
+            turn (int): The specified turn.
+
+        Returns:
+            List[Message]: A list of the messages of the turn.
+        """
+        if not self._ordered:
+            return [message for message in self._messages if message.turn == turn]
+        return self._messages[bisect_left(self._turns, turn):bisect_left(self._turns, turn + 1)]
+
     def get_visible_messages(self, agent_name, turn: int) -> List[Message]:
         """
         Get all the messages that are visible to a given agent before a specified turn.
@@ -123,12 +204,11 @@ class MessagePool:
         Returns:
             List[Message]: A list of visible messages.
         """
-
-        # Get the messages before the current turn
-        prev_messages = [message for message in self._messages if message.turn < turn]
-
-        visible_messages = []
-        for message in prev_messages:
-            if message.visible_to == "all" or agent_name in message.visible_to:
-                visible_messages.append(message)
-        return visible_messages
+        if not self._ordered:
+            return [
+                message for message in self._messages
+                if message.turn < turn and (message.visible_to == "all" or agent_name in self._recipients(message))
+            ]
+
+        view, turns = self._view(agent_name)
+        return view[:bisect_left(turns, turn)]
@@ -0,0 +1,187 @@
+import os
+import json
+import mmap
+import fcntl
+import random
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence, Union
+import numpy as np
+from fire import Fire
+
+
+class PersonaStore:
+    r"""
+    Read-only, memory-mapped store of simulated-user personas built by `build_persona_index`.
+
+    An index directory holds:
+        personas.jsonl   one persona per line (`description` plus the indexed attributes)
+        offsets.npy      uint64 byte offsets of the lines, with the file size appended
+        rows.npy         persona rows grouped by attribute value
+        attributes.json  {attribute: {value: [start, end]}} slices of `rows.npy`
+        index.json       the modification time of the dataset and the indexed attributes
+
+    Nothing is parsed at start-up, and the pages are shared between processes, so many simulator workers
+    can open the same store cheaply. A persona is decoded only when it is read, and sampling is O(1).
+    """
+
+    def __init__(self, index_dir: str) -> None:
+        self.index_dir = index_dir
+        self._file = open(os.path.join(index_dir, "personas.jsonl"), "rb")
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(index_dir, "rows.npy"), mmap_mode="r")
+        with open(os.path.join(index_dir, "attributes.json"), "r", encoding="utf-8") as file:
+            self.attributes: Dict[str, Dict[str, List[int]]] = json.load(file)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        return json.loads(self._data[int(self.offsets[idx]):int(self.offsets[idx + 1])])
+
+    def description(self, idx: int) -> str:
+        return self[idx]["description"]
+
+    def select(self, **filters: Any) -> Union[range, np.ndarray]:
+        r"""
+        Returns the rows whose attributes equal all `filters`, e.g. `select(topic="家庭")`.
+        """
+        selected = None
+        for attribute, value in filters.items():
+            if attribute not in self.attributes:
+                raise KeyError(f"Attribute {attribute} is not indexed, rebuild the index with it.")
+            start, end = self.attributes[attribute].get(str(value), (0, 0))
+            rows = self.rows[start:end]
+            selected = rows if selected is None else np.intersect1d(selected, rows, assume_unique=True)
+        return range(len(self)) if selected is None else selected
+
+    def sample(self, rng: Optional[random.Random] = None, **filters: Any) -> Dict[str, Any]:
+        rows = self.select(**filters)
+        if len(rows) == 0:
+            raise ValueError(f"No persona matches {filters}.")
+        rng = rng or random
+        return self[int(rows[rng.randrange(len(rows))])]
+
+    def close(self) -> None:
+        self._data.close()
+        self._file.close()
+
+
+def _attribute_values(value: Any) -> List[str]:
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+    return [] if value is None else [str(value)]
+
+
+def build_persona_index(
+        dataset_path: str, index_dir: Optional[str] = None, attributes: Sequence[str] = ()
+) -> str:
+    r"""
+    Converts a JSON dataset (a list of dialogues with a `description`) into a `PersonaStore` index and
+    returns its directory, by default `{dataset_path without .json}.personas`. List-valued attributes are
+    indexed under each of their items.
+
+    The index is written to a temporary directory and then swapped in, so a store already opened on the old
+    index keeps reading consistent files.
+    """
+    if isinstance(attributes, str):
+        attributes = [attributes]
+    index_dir = os.path.abspath(index_dir or f"{os.path.splitext(dataset_path)[0]}.personas")
+    dataset_mtime = os.path.getmtime(dataset_path)
+    with open(dataset_path, "r", encoding="utf-8") as file:
+        raw_data = json.load(file)
+
+    build_dir = tempfile.mkdtemp(prefix=f".{os.path.basename(index_dir)}.", dir=os.path.dirname(index_dir))
+    try:
+        offsets = [0]
+        groups: Dict[str, Dict[str, List[int]]] = {attribute: {} for attribute in attributes}
+        with open(os.path.join(build_dir, "personas.jsonl"), "wb") as file:
+            for idx, line in enumerate(raw_data):
+                persona = {"description": line["description"]}
+                persona.update({attribute: line.get(attribute) for attribute in attributes})
+                file.write((json.dumps(persona, ensure_ascii=False) + "\n").encode("utf-8"))
+                offsets.append(file.tell())
+                for attribute in attributes:
+                    for value in _attribute_values(line.get(attribute)):
+                        groups[attribute].setdefault(value, []).append(idx)
+
+        rows, slices = [], {}
+        for attribute, values in groups.items():
+            slices[attribute] = {}
+            for value, value_rows in values.items():
+                slices[attribute][value] = [len(rows), len(rows) + len(value_rows)]
+                rows.extend(value_rows)
+
+        np.save(os.path.join(build_dir, "offsets.npy"), np.asarray(offsets, dtype=np.uint64))
+        np.save(os.path.join(build_dir, "rows.npy"), np.asarray(rows, dtype=np.uint32))
+        with open(os.path.join(build_dir, "attributes.json"), "w", encoding="utf-8") as file:
+            json.dump(slices, file, ensure_ascii=False)
+        with open(os.path.join(build_dir, "index.json"), "w", encoding="utf-8") as file:
+            json.dump({"dataset_mtime": dataset_mtime, "attributes": list(attributes)}, file, ensure_ascii=False)
+
+        # a directory cannot be replaced in one step: move the old index aside, then remove it once the new one
+        # is in place (open memory maps keep its files alive)
+        old_dir = None
+        if os.path.exists(index_dir):
+            old_dir = tempfile.mkdtemp(prefix=f".{os.path.basename(index_dir)}.old.", dir=os.path.dirname(index_dir))
+            os.replace(index_dir, old_dir)
+        os.replace(build_dir, index_dir)
+        if old_dir is not None:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    return index_dir
+
+
+@contextmanager
+def _index_lock(index_dir: str, exclusive: bool):
+    # readers share the lock, a (re)build takes it alone, so no worker opens an index while it is swapped
+    with open(f"{index_dir}.lock", "a") as file:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def _index_meta(index_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(index_dir, "index.json"), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None  # no index yet, or one built before `index.json` existed
+
+
+def _is_fresh(meta: Optional[Dict[str, Any]], dataset_path: str, attributes: Sequence[str]) -> bool:
+    return (
+        meta is not None
+        and meta["dataset_mtime"] == os.path.getmtime(dataset_path)
+        and set(attributes) <= set(meta["attributes"])
+    )
+
+
+def load_personas(dataset_path: str, attributes: Sequence[str] = ()) -> PersonaStore:
+    r"""
+    Opens the persona index next to `dataset_path`. The index is (re)built if it does not exist yet, if the
+    dataset changed since, or if it lacks one of `attributes`; a rebuild keeps the attributes already indexed.
+    """
+    if isinstance(attributes, str):
+        attributes = [attributes]
+    index_dir = f"{os.path.splitext(dataset_path)[0]}.personas"
+    with _index_lock(index_dir, exclusive=False):
+        if _is_fresh(_index_meta(index_dir), dataset_path, attributes):
+            return PersonaStore(index_dir)
+
+    with _index_lock(index_dir, exclusive=True):
+        meta = _index_meta(index_dir)
+        if not _is_fresh(meta, dataset_path, attributes):  # another worker may have rebuilt it meanwhile
+            indexed = meta["attributes"] if meta is not None else []
+            attributes = indexed + [name for name in attributes if name not in indexed]
+            build_persona_index(dataset_path, index_dir, attributes)
+        return PersonaStore(index_dir)
+
+
+if __name__ == "__main__":
+    Fire(build_persona_index)
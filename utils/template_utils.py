@@ -2,10 +2,15 @@
 # It includes the templates / prompts for model training or generation.
 
 from dataclasses import dataclass
-from typing import Dict, List, Sequence, Any, Union
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Any, Tuple, Union
 from llamafactory.data import Role
 from utils.config_utils import ROLE_MAP
 
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizer
+    from llamafactory.data import Template
+
 
 @dataclass
 class InferTemplate:
@@ -35,6 +40,17 @@ class InferTemplate:
         messages[0]['content'] = self.system + messages[0]['content']
         return messages
 
+    def format_segments(self, target_data: List[Dict[str, str]]) -> List[str]:
+        """
+        Splits the user prompt of `format_example` into the fixed head, one segment per turn and the fixed tail.
+        """
+        head, tail = self.context.split('{conversation}')
+        segments = [self.system + head]
+        for idx, turn in enumerate(target_data):
+            segments.append(('\n' if idx > 0 else '') + f"{ROLE_MAP[turn['role']]}: {turn['content']}")
+        segments.append(tail + self.response)
+        return segments
+
 
 @dataclass
 class UserTemplate:
@@ -74,6 +90,22 @@ class UserTemplate:
         messages.append({'role': Role.ASSISTANT.value, 'content': ''})
         return messages
 
+    def format_segments(self, target_data: Dict[str, Any]) -> List[str]:
+        """
+        Splits the user prompt of `format_example` into append-only segments, like `EmpatheticLLM.format_segments`.
+        The opening prompt (no conversation yet) is a single segment.
+        """
+        description = target_data.get('description', '')
+        conversation = target_data.get('conversation', [])
+        if not conversation:
+            return [self.format_example(target_data)[0]['content']]
+        head, tail = self.context.split('{conversation}')
+        segments = [self.system + head.format(description=description)]
+        for idx, turn in enumerate(conversation):
+            segments.append(('\n\t' if idx > 0 else '') + f"{ROLE_MAP[turn['role']]}: {turn['content']}")
+        segments.append(tail)
+        return segments
+
 
 @dataclass
 class EmpatheticLLM:
@@ -102,6 +134,19 @@ class EmpatheticLLM:
         messages.append({'role': Role.ASSISTANT.value, 'content': ''})
         return messages
 
+    def format_segments(self, target_data: Dict[str, Any]) -> List[str]:
+        """
+        Splits the user prompt of `format_example` into append-only segments: the fixed head, one segment per
+        turn (each new turn carries its own separator) and the fixed tail. Use with `encode_segments` or
+        `SegmentEncoder`.
+        """
+        head, tail = self.context.split('{conversation}')
+        segments = [self.system + head]
+        for idx, turn in enumerate(target_data.get('conversation')):
+            segments.append(('\n\t' if idx > 0 else '') + f"{ROLE_MAP[turn['role']]}: {turn['content']}")
+        segments.append(tail)
+        return segments
+
 
 @dataclass
 class COTTemplate:
@@ -151,6 +196,153 @@ class COTTemplate:
             messages[0]['content'] = self.system + messages[0]['content']
         return messages
 
+    def format_segments(self, target_data: Dict[str, Any], contrast: bool = False) -> List[str]:
+        """
+        Splits the user prompt of `format_example` (without a support set) into the fixed head, one segment per
+        turn and the formatted tail.
+        """
+        head, tail = self.context.split('{conversation}')
+        if contrast:
+            fields = {'response': target_data['response'], 'contrast': target_data['contrast']}
+            tail = tail.format(**fields) + self.response.format(**fields)
+        else:
+            tail = tail.format(response=target_data['response'], user_state=target_data['user_state'])
+            tail = tail.replace(f'我对来访者有如下判断：\n{None}\n', '')
+            tail += self.response.format(response=target_data['response'])
+        segments = [self.system + head]
+        for idx, turn in enumerate(target_data['conversation']):
+            segments.append(('\n' if idx > 0 else '') + f"{ROLE_MAP[turn['role']]}: {turn['content']}")
+        segments.append(tail)
+        return segments
+
+
+def _user_slot_ids(
+        template: "Template", tokenizer: "PreTrainedTokenizer", system: Optional[str] = None
+) -> Tuple[List[int], List[int]]:
+    r"""
+    Returns the token ids of a single-turn prompt before and after the user content.
+    """
+    sentinel = '{segments}'
+    system = system or template.default_system
+    elements = template.format_prefix.apply()
+    if system:
+        elements += template.format_system.apply(content=system)
+    elements += template.format_user.apply(content=sentinel, idx='0')
+
+    head, tail = [], []
+    for element in elements:
+        if tail or (isinstance(element, str) and sentinel in element):
+            if not tail:
+                before, element = element.split(sentinel)
+                head.append(before)
+            tail.append(element)
+        else:
+            head.append(element)
+    return template._convert_elements_to_ids(tokenizer, head), template._convert_elements_to_ids(tokenizer, tail)
+
+
+def encode_segments(
+        template: "Template",
+        tokenizer: "PreTrainedTokenizer",
+        segments: List[str],
+        system: Optional[str] = None
+) -> List[int]:
+    r"""
+    Encodes a single-turn prompt whose user content is `''.join(segments)`, like `template.encode_oneturn`,
+    but tokenizes every segment on its own. Appending a segment then never changes the token ids before it,
+    so the prompts of consecutive turns share an exact token prefix that the prefix cache can reuse.
+    """
+    head, tail = _user_slot_ids(template, tokenizer, system)
+    input_ids = list(head)
+    for segment in segments:
+        input_ids += tokenizer.encode(segment, add_special_tokens=False)
+    return input_ids + tail
+
+
+class SegmentEncoder:
+    r"""
+    `encode_segments` with cached token ids.
+
+    The ids of every segment (the fixed system and context fragments, and each turn already seen) are kept in an
+    LRU keyed by the segment text, and the chat-template ids around the user content are kept per system prompt.
+    Encoding a conversation then tokenizes only its new turns and concatenates the cached ids of the rest.
+    """
+
+    def __init__(self, template: "Template", tokenizer: "PreTrainedTokenizer", cache_size: int = 65536) -> None:
+        self.template = template
+        self.tokenizer = tokenizer
+        self.segment_ids = lru_cache(maxsize=cache_size)(self._segment_ids)
+        self.slot_ids = lru_cache(maxsize=16)(self._slot_ids)
+
+    def _segment_ids(self, segment: str) -> Tuple[int, ...]:
+        return tuple(self.tokenizer.encode(segment, add_special_tokens=False))
+
+    def _slot_ids(self, system: Optional[str]) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+        head, tail = _user_slot_ids(self.template, self.tokenizer, system)
+        return tuple(head), tuple(tail)
+
+    def encode(self, segments: List[str], system: Optional[str] = None) -> List[int]:
+        head, tail = self.slot_ids(system)
+        input_ids = list(head)
+        for segment in segments:
+            input_ids.extend(self.segment_ids(segment))
+        input_ids.extend(tail)
+        return input_ids
+
+
+class HistoryManager:
+    r"""
+    Keeps a conversation within a token budget before it is formatted into a prompt.
+
+    The latest `keep_last` turns are always kept. Older turns are kept from newest to oldest while they fit in
+    `max_tokens`, after reserving the fixed system and context text of `template`. The kept window starts at an even
+    index, so it opens with the same role as the full conversation. Token counts are cached per turn, so each turn
+    is tokenized once instead of re-tokenizing the whole history every turn.
+    """
+
+    def __init__(
+            self,
+            tokenizer: "PreTrainedTokenizer",
+            max_tokens: int,
+            keep_last: int = 4,
+            template: Optional[Union["COTTemplate", "InferTemplate", "UserTemplate", "EmpatheticLLM"]] = None,
+            cache_size: int = 65536
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.keep_last = keep_last
+        self.count_text = lru_cache(maxsize=cache_size)(self._count_text)
+        self.reserved_tokens = self.count_text(template.system + template.context) if template is not None else 0
+
+    def _count_text(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def count_turn(self, turn: Dict[str, str]) -> int:
+        # one extra token for the separator between turns
+        return self.count_text(f"{ROLE_MAP[turn['role']]}: {turn['content']}") + 1
+
+    def window(self, conversation: List[Dict[str, str]], reserved_tokens: int = 0) -> int:
+        """
+        Returns the index of the first turn to keep. `reserved_tokens` accounts for other prompt text,
+        such as the description of a simulated user.
+        """
+        budget = self.max_tokens - self.reserved_tokens - reserved_tokens
+        start = max(len(conversation) - self.keep_last, 0)
+        budget -= sum(self.count_turn(turn) for turn in conversation[start:])
+        while start > 0:
+            cost = self.count_turn(conversation[start - 1])
+            if cost > budget:
+                break
+            budget -= cost
+            start -= 1
+
+        if start % 2 == 1:
+            start = start + 1 if start + 1 <= len(conversation) - self.keep_last else start - 1
+        return start
+
+    def truncate(self, conversation: List[Dict[str, str]], reserved_tokens: int = 0) -> List[Dict[str, str]]:
+        return conversation[self.window(conversation, reserved_tokens):]
+
 
 templates: Dict[str, Union["COTTemplate", "InferTemplate", "UserTemplate", "EmpatheticLLM"]] = {}
 